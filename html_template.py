@@ -5,8 +5,22 @@ Supporting basic constructs:
 2. loop {% for val in vals %}... {% endfor %}
 3. conditional {% if exp %} {% else %} {% endif %}
 4. function call {% call funtion_name(arguments) %}
+5. fragment cache {% cache key ttl %}...{% endcache %}, the output of the block is kept
+   ttl seconds under the value of the key expression
+
+A compiled template is turned into the source of a single python function, which is
+compiled once: expressions become inline python code and the output is collected in
+a list joined at the end. Names in expressions are looked up in the context, then in
+the builtins, and are None when missing.
+`python html_template.py benchmark` compares it with walking the node tree, and
+measures the compile time of templates up to 1MB.
+
+Template.generate renders in chunks instead, which a wsgi application can return as
+its response to send a large page while it's rendered.
+
+TemplateLoader loads templates from files, keeping the compiled ones in memory.
 """
-import re, collections
+import re, os, sys, time, threading, collections, keyword, ast, __builtin__
 
 class Context(object):
     def __init__(self, context):
@@ -30,76 +44,123 @@ class Context(object):
                 return c[varname]
         return None
         
+class TemplateSyntaxError(Exception):
+    def __init__(self, message, line, column):
+        Exception.__init__(self, "%s at line %d, column %d"%(message, line, column))
+        self.line = line
+        self.column = column
+
 class Template(object):
     SEG_REGEX = re.compile(r"({{.*?}}|{%.*?%})")
     LOOP_REGEX = re.compile(r"for[\s+]([^\s]*)[\s+]in[\s+](.*)$")
     COND_REGEX = re.compile(r"if[\s+](.*)")
     CALL_REGEX = re.compile(r"call[\s+]([a-zA-Z0-9_]+)\((.*)\)")
+    CACHE_REGEX = re.compile(r"cache\s+(.+)\s+(\S+)$")
     
-    def __init__(self, template_str):
+    def __init__(self, template_str, fragment_cache=None):
         self.template = template_str
-         
+        # where {% cache %} blocks keep their output
+        self.fragment_cache = fragment_cache or default_fragment_cache
+
+    # The text and tags of the template with their line and column, found in one pass
     def _tokenize(self):
-        self.tokens = self.SEG_REGEX.split(self.template)
+        template = self.template
+        self.tokens = []
+        line, line_start, last = 1, 0, 0
+        for match in self.SEG_REGEX.finditer(template):
+            start = match.start()
+            if start > last:
+                self.tokens.append((template[last:start], line, last - line_start + 1))
+                newlines = template.count("\n", last, start)
+                if newlines:
+                    line += newlines
+                    line_start = template.rfind("\n", last, start) + 1
+            self.tokens.append((match.group(), line, start - line_start + 1))
+            last = match.end()
+        if last < len(template):
+            self.tokens.append((template[last:], line, last - line_start + 1))
 
     def compile(self):
         self._tokenize()
+        # tokens are consumed by moving the cursor forward
+        self.cursor = 0
         self.nodes = []
-        while self.tokens:
+        while self.cursor < len(self.tokens):
             node = self._get_next_node()
+            if isinstance(node, SENTINELS):
+                raise TemplateSyntaxError("Unexpected %s"%node.token, node.line, node.column)
             self.nodes.append(node)
-            
-    def _get_next_node(self):
-        if not self.tokens:
-            raise Exception("The template string is invalid")
-        token = self.tokens.pop(0)
+        gen = CodeGenerator()
+        self.source = gen.generate(self.nodes)
+        self.render_function = gen.compile(self.source, self)
+        # generated the first time generate() is called
+        self.generate_function = None
+
+    def _get_next_node(self, opening=None):
+        if self.cursor >= len(self.tokens):
+            raise TemplateSyntaxError("Unclosed %s"%opening.token, opening.line, opening.column)
+        token, line, column = self.tokens[self.cursor]
+        self.cursor += 1
+        node = self._make_node(token)
+        node.token, node.line, node.column = token, line, column
+        if isinstance(node, LoopNode):
+            while True:
+                child = self._get_next_node(node)
+                if isinstance(child, EndLoopNode):
+                    break
+                if isinstance(child, SENTINELS):
+                    raise TemplateSyntaxError("Unexpected %s in %s"%(child.token, node.token),
+                                              child.line, child.column)
+                node.children.append(child)
+        elif isinstance(node, CondNode):
+            in_list = node.true_children
+            while True:
+                child = self._get_next_node(node)
+                if isinstance(child, ElseNode) and in_list is node.true_children:
+                    in_list = node.false_children
+                    continue
+                elif isinstance(child, EndIfNode):
+                    break
+                elif isinstance(child, SENTINELS):
+                    raise TemplateSyntaxError("Unexpected %s in %s"%(child.token, node.token),
+                                              child.line, child.column)
+                in_list.append(child)
+        elif isinstance(node, CacheNode):
+            while True:
+                child = self._get_next_node(node)
+                if isinstance(child, EndCacheNode):
+                    break
+                if isinstance(child, SENTINELS):
+                    raise TemplateSyntaxError("Unexpected %s in %s"%(child.token, node.token),
+                                              child.line, child.column)
+                node.children.append(child)
+        return node
+
+    # the node of a token, without its children
+    def _make_node(self, token):
         if token.startswith("{{"):
             # this is a var
-            varname = token[2:-2].strip()
-            varnode = VarNode(varname)
-            return varnode
+            return VarNode(token[2:-2].strip())
         elif token.startswith("{%"):
             # this is a block 
             inner = token[2:-2].strip()
             # is it a loop node?
             loop_match = self.LOOP_REGEX.match(inner)
             if loop_match:
-                loop_var = loop_match.group(1)
-                loop_list = loop_match.group(2)
-                loopnode = LoopNode(loop_var, loop_list)
-                children = []
-                while True:
-                    node = self._get_next_node()
-                    if isinstance(node, EndLoopNode):
-                        break
-                    children.append(node)
-                loopnode.children = children
-                return loopnode
+                return LoopNode(loop_match.group(1), loop_match.group(2))
             # is it a conditional node?
             cond_match = self.COND_REGEX.match(inner)
             if cond_match:
-                condnode = CondNode(cond_match.group(1))
-                truenodes = []
-                falsenodes = []
-                in_list = truenodes
-                while True:
-                    node = self._get_next_node()
-                    if isinstance(node, ElseNode):
-                        in_list = falsenodes
-                        continue
-                    elif isinstance(node, EndIfNode):
-                        break
-                    in_list.append(node)
-                condnode.true_children = truenodes
-                condnode.false_children = falsenodes
-                return condnode
+                return CondNode(cond_match.group(1))
             # is it a function call
             call_match = self.CALL_REGEX.match(inner)
             if call_match:
                 fname = call_match.group(1)
                 arguments = [arg.strip() for arg in call_match.group(2).split(",")]
-                callnode = CallNode(fname, arguments)
-                return callnode
+                return CallNode(fname, arguments)
+            cache_match = self.CACHE_REGEX.match(inner)
+            if cache_match:
+                return CacheNode(cache_match.group(1), cache_match.group(2), self)
             # Other sentinel nodes: ELSE ENDIF ENDFOR
             if inner.lower()=="else":
                 return ElseNode()
@@ -107,23 +168,203 @@ class Template(object):
                 return EndIfNode()
             if inner.lower()=="endfor":
                 return EndLoopNode()
+            if inner.lower()=="endcache":
+                return EndCacheNode()
+            raise TemplateSyntaxError("Unknown tag %s"%token, *self.tokens[self.cursor - 1][1:])
         else:
             return TextNode(token)
-                                                            
+
     def render(self, context):
+        return self.render_function(context)
+
+    # Render in chunks of about buffer_size bytes, yielded as loop iterations and text
+    # complete, so a wsgi application can return it and start sending right away
+    def generate(self, context, buffer_size=8192):
+        if self.generate_function is None:
+            gen = CodeGenerator(streaming=True)
+            self.generate_function = gen.compile(gen.generate(self.nodes), self)
+        return self.generate_function(context, buffer_size)
+
+    # walk the node tree instead of running the compiled code, slower
+    def render_nodes(self, context):
         result_str = ""
         for node in self.nodes:
             result_str += node.render(context)
         return result_str
-        
+
+# Names for the generated code, prefixed not to clash with the template's names
+def lookup(context, name):
+    if name in context:
+        return context[name]
+    return getattr(__builtin__, name, None)
+
+def check_iterable(value, expression):
+    if not isinstance(value, collections.Iterable):
+        raise Exception("Var %s missing from context, or is not an iterable"%expression)
+    return value
+
+def missing(name):
+    raise Exception("Var %s missing from context"%name)
+
+def not_callable(name):
+    raise Exception("Var %s missing from context, or not callable"%name)
+
+RUNTIME = {
+    "_tpl_lookup": lookup,
+    "_tpl_check_iterable": check_iterable,
+    "_tpl_missing": missing,
+    "_tpl_not_callable": not_callable,
+    "_tpl_str": str,
+    "_tpl_enumerate": enumerate,
+    "_tpl_callable": callable,
+    "_tpl_len": len,
+}
+
+IDENTIFIER_REGEX = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+def is_identifier(name):
+    return bool(IDENTIFIER_REGEX.match(name)) and not keyword.iskeyword(name) and name != "None"
+
+# names an expression reads, including those of nested lambdas and generators
+def expression_names(expression):
+    names = set()
+    codes = [compile(expression, "<template>", "eval")]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(c for c in code.co_consts if hasattr(c, "co_names"))
+    return names
+
+# list comprehensions assign their variables in the scope they run in
+def has_list_comprehension(expression):
+    return any(isinstance(node, ast.ListComp) for node in ast.walk(ast.parse(expression, mode="eval")))
+
+# Turns the nodes of a template into the source of a function rendering them.
+# Every name of the template is a local of the function, loaded from the context when
+# it's called: a loop assigns its variable and "it", and restores them once done.
+# A streaming generator makes a python generator, yielding the output gathered once
+# it reaches a buffer size, checked after text and at the end of loop iterations
+class CodeGenerator(object):
+    def __init__(self, streaming=False):
+        self.streaming = streaming
+        self.lines = []
+        self.level = 1
+        self.names = set()
+        # names tested for presence in the context, loops and temporaries
+        self.checked = set()
+        self.loop_vars = []
+        self.counter = 0
+        self.uses_fragment_cache = False
+        # output isn't yielded in the middle of a cached fragment
+        self.no_flush = 0
+
+    def write(self, line):
+        self.lines.append("    " * self.level + line)
+
+    def indent(self):
+        self.level += 1
+
+    def dedent(self):
+        self.level -= 1
+
+    def temporary(self, prefix):
+        self.counter += 1
+        return "_tpl_%s%d"%(prefix, self.counter)
+
+    # python expression of a template expression of node
+    def expression(self, expression, node):
+        try:
+            names = expression_names(expression)
+        except SyntaxError, e:
+            raise TemplateSyntaxError("Invalid expression %s: %s"%(expression, e.msg),
+                                      node.line, node.column)
+        self.names.update(name for name in names if is_identifier(name))
+        if has_list_comprehension(expression):
+            # in a scope of its own, not to overwrite the template's names
+            return "(lambda: (%s))()"%expression
+        return "(%s)"%expression
+
+    # local holding the value of name, and whether it may be missing from the context
+    def variable(self, name):
+        self.names.add(name)
+        if any(name in loop_vars for loop_vars in self.loop_vars):
+            return name, False
+        self.checked.add(name)
+        return name, True
+
+    # append the value of python code, a string, to the output
+    def output(self, code):
+        if self.streaming:
+            self.write("_tpl_chunk = %s"%code)
+            self.write("_tpl_append(_tpl_chunk)")
+            self.write("_tpl_size += _tpl_len(_tpl_chunk)")
+        else:
+            self.write("_tpl_append(%s)"%code)
+
+    def output_text(self, text):
+        self.write("_tpl_append(%r)"%text)
+        if self.streaming:
+            self.write("_tpl_size += %d"%len(text))
+            self.flush()
+
+    def flush(self):
+        if self.streaming and not self.no_flush:
+            self.write("if _tpl_size >= _tpl_buffer_size:")
+            self.indent()
+            self.write("yield ''.join(_tpl_out)")
+            self.write("del _tpl_out[:]")
+            self.write("_tpl_size = 0")
+            self.dedent()
+
+    def block(self, nodes):
+        start = len(self.lines)
+        for node in nodes:
+            node.generate(self)
+        if len(self.lines) == start:
+            self.write("pass")
+
+    def generate(self, nodes):
+        self.block(nodes)
+        body = self.lines
+        self.lines = []
+        self.write("_tpl_out = []")
+        self.write("_tpl_append = _tpl_out.append")
+        for name in sorted(self.names):
+            self.write("%s = _tpl_lookup(_tpl_context, %r)"%(name, name))
+        for name in sorted(self.checked):
+            self.write("_tpl_has_%s = %r in _tpl_context"%(name, name))
+        if self.uses_fragment_cache:
+            self.write("_tpl_fragments = _tpl_template.fragment_cache")
+        if self.streaming:
+            self.write("_tpl_size = 0")
+            body = self.lines + body
+            body.append("    if _tpl_out:")
+            body.append("        yield ''.join(_tpl_out)")
+            return "def render(_tpl_context, _tpl_buffer_size):\n" + "\n".join(body) + "\n"
+        body = self.lines + body
+        body.append("    return ''.join(_tpl_out)")
+        return "def render(_tpl_context):\n" + "\n".join(body) + "\n"
+
+    def compile(self, source, template):
+        namespace = dict(RUNTIME)
+        namespace["_tpl_template"] = template
+        exec compile(source, "<template>", "exec") in namespace
+        return namespace["render"]
+
 class Node(object):
-    pass
+    # the tag or text of the node, and where it starts in the template
+    token = ""
+    line = column = 0
 
 class TextNode(Node):
     def __init__(self, text):
         self.text = text
     def render(self, context):
         return self.text
+
+    def generate(self, gen):
+        if self.text:
+            gen.output_text(self.text)
     
 class VarNode(Node):
     def __init__(self, var):
@@ -134,6 +375,17 @@ class VarNode(Node):
             raise Exception("Var %s missing from context"%self.var)
         return str(context[self.var])
 
+    def generate(self, gen):
+        if not is_identifier(self.var):
+            # can't be a local, like {{ user.name }} which is a name of the context
+            gen.write("if %r not in _tpl_context: _tpl_missing(%r)"%(self.var, self.var))
+            gen.output("_tpl_str(_tpl_context[%r])"%self.var)
+            return
+        local, may_be_missing = gen.variable(self.var)
+        if may_be_missing:
+            gen.write("if not _tpl_has_%s: _tpl_missing(%r)"%(local, self.var))
+        gen.output("_tpl_str(%s)"%local)
+
 class LoopNode(Node):
     def __init__(self, loop_var, loop_list):
         self.loop_var = loop_var
@@ -163,6 +415,27 @@ class LoopNode(Node):
                 
         context.pop_context()
         return result_str
+
+    def generate(self, gen):
+        if not is_identifier(self.loop_var):
+            raise TemplateSyntaxError("Invalid loop variable %s"%self.loop_var, self.line, self.column)
+        if is_identifier(self.loop_list):
+            gen.names.add(self.loop_list)
+            iterable = self.loop_list
+        else:
+            iterable = gen.expression(self.loop_list, self)
+        gen.names.update(("it", self.loop_var))
+        saved = gen.temporary("saved")
+        gen.write("%s = it, %s"%(saved, self.loop_var))
+        gen.write("for it, %s in _tpl_enumerate(_tpl_check_iterable(%s, %r)):"
+                  %(self.loop_var, iterable, self.loop_list))
+        gen.indent()
+        gen.loop_vars.append(("it", self.loop_var))
+        gen.block(self.children)
+        gen.flush()
+        gen.loop_vars.pop()
+        gen.dedent()
+        gen.write("it, %s = %s"%(self.loop_var, saved))
         
 class CondNode(Node):
     def __init__(self, exp):
@@ -180,6 +453,17 @@ class CondNode(Node):
         for child in children:
             result_str += child.render(context)
         return result_str
+
+    def generate(self, gen):
+        gen.write("if %s:"%gen.expression(self.exp, self))
+        gen.indent()
+        gen.block(self.true_children)
+        gen.dedent()
+        if self.false_children:
+            gen.write("else:")
+            gen.indent()
+            gen.block(self.false_children)
+            gen.dedent()
         
 class CallNode(Node):
     def __init__(self, fname, args):
@@ -191,7 +475,59 @@ class CallNode(Node):
         arguments = [eval(arg, {}, context) for arg in self.args]
         result = context[self.fname](*arguments)
         return str(result)
+
+    def generate(self, gen):
+        if not is_identifier(self.fname):
+            raise TemplateSyntaxError("Invalid function name %s"%self.fname, self.line, self.column)
+        local, may_be_missing = gen.variable(self.fname)
+        check = "not _tpl_callable(%s)"%local
+        if may_be_missing:
+            check = "not _tpl_has_%s or %s"%(local, check)
+        gen.write("if %s: _tpl_not_callable(%r)"%(check, self.fname))
+        # call f() has a single empty argument
+        arguments = ", ".join(gen.expression(arg, self) for arg in self.args if arg)
+        gen.output("_tpl_str(%s(%s))"%(local, arguments))
             
+class CacheNode(Node):
+    def __init__(self, key, ttl, template):
+        self.key = key
+        self.ttl = ttl
+        self.template = template
+        self.children = []
+
+    def render(self, context):
+        cache = self.template.fragment_cache
+        key = str(eval(self.key, {}, context))
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = ""
+            for child in self.children:
+                fragment += child.render(context)
+            cache.set(key, fragment, eval(self.ttl, {}, context))
+        return fragment
+
+    def generate(self, gen):
+        gen.uses_fragment_cache = True
+        key = gen.temporary("key")
+        fragment = gen.temporary("fragment")
+        start = gen.temporary("start")
+        gen.write("%s = _tpl_str(%s)"%(key, gen.expression(self.key, self)))
+        gen.write("%s = _tpl_fragments.get(%s)"%(fragment, key))
+        gen.write("if %s is not None:"%fragment)
+        gen.indent()
+        gen.output(fragment)
+        gen.dedent()
+        gen.write("else:")
+        gen.indent()
+        gen.write("%s = _tpl_len(_tpl_out)"%start)
+        gen.no_flush += 1
+        gen.block(self.children)
+        gen.no_flush -= 1
+        gen.write("_tpl_fragments.set(%s, ''.join(_tpl_out[%s:]), %s)"
+                  %(key, start, gen.expression(self.ttl, self)))
+        gen.dedent()
+        gen.flush()
+
 # Sentinels
 class EndLoopNode(Node):
     pass
@@ -202,10 +538,144 @@ class ElseNode(Node):
 class EndIfNode(Node):
     pass
 
+class EndCacheNode(Node):
+    pass
+
+SENTINELS = (EndLoopNode, ElseNode, EndIfNode, EndCacheNode)
+
+
+# Where {% cache %} blocks keep their fragments. get returns None for a key missing or
+# expired, set keeps a fragment ttl seconds (0 for no expiry). Keys are shared by all
+# the templates using a cache. A cache shared by processes, on memcached or redis, only
+# needs these two methods
+class FragmentCache(object):
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, fragment, ttl):
+        raise NotImplementedError
+
+# Fragments kept in memory, at most max_fragments of them, least recently used first out
+class MemoryFragmentCache(FragmentCache):
+    def __init__(self, max_fragments=1000):
+        self.fragments = LRUCache(max_fragments)
+
+    def get(self, key):
+        entry = self.fragments.get(key)
+        if entry is None:
+            return None
+        expires, fragment = entry
+        if expires and expires < time.time():
+            # left for set to replace, another thread may be doing it already
+            return None
+        return fragment
+
+    def set(self, key, fragment, ttl):
+        self.fragments.put(key, (time.time() + ttl if ttl else 0, fragment))
+
+class TemplateNotFound(Exception):
+    "Raised when no directory of the search path has the template"
+
+# A mapping keeping at most max_size items, evicting the least recently used.
+# Safe to share between threads
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+# Loads templates by name from the directories of search_path, the first having the
+# file wins. Compiled templates are cached, up to max_templates of them, and
+# compiled again when their file changes: its modification time or size differs.
+# Checking a file costs a stat call, check_interval sets the seconds between two
+# checks of a template
+class TemplateLoader(object):
+    def __init__(self, search_path, max_templates=100, check_interval=0, fragment_cache=None):
+        if isinstance(search_path, basestring):
+            search_path = [search_path]
+        self.search_path = [os.path.abspath(d) for d in search_path]
+        self.check_interval = check_interval
+        self.fragment_cache = fragment_cache
+        # name: (template, path, (mtime, size), time of the last check)
+        self.cache = LRUCache(max_templates)
+
+    def find(self, name):
+        for directory in self.search_path:
+            path = os.path.normpath(os.path.join(directory, name))
+            if not path.startswith(directory + os.sep):
+                # a name like ../../etc/passwd
+                continue
+            if os.path.isfile(path):
+                return path
+        raise TemplateNotFound("Template %s not found in %s"%(name, os.pathsep.join(self.search_path)))
+
+    def get_template(self, name):
+        entry = self.cache.get(name)
+        now = time.time()
+        if entry is not None:
+            tpl, path, version, checked = entry
+            if now - checked < self.check_interval:
+                return tpl
+            try:
+                if file_version(path) == version:
+                    self.cache.put(name, (tpl, path, version, now))
+                    return tpl
+            except OSError:
+                # removed, maybe another directory of the search path has it
+                pass
+        path = self.find(name)
+        # compiled without holding a lock, threads may compile it at the same time
+        version = file_version(path)
+        with open(path) as f:
+            tpl = Template(f.read(), self.fragment_cache)
+        tpl.compile()
+        self.cache.put(name, (tpl, path, version, now))
+        return tpl
+
+    def render(self, name, context):
+        return self.get_template(name).render(Context(context))
+
+def file_version(path):
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+default_fragment_cache = MemoryFragmentCache()
+
+# templates of render_string_template, by their source
+string_templates = LRUCache(100)
 
 def render_string_template(template_str, context):
-    tpl = Template(template_str)
-    tpl.compile()
+    tpl = string_templates.get(template_str)
+    if tpl is None:
+        tpl = Template(template_str)
+        tpl.compile()
+        string_templates.put(template_str, tpl)
     
     ctx = Context(context)
     return tpl.render(ctx)
@@ -224,7 +694,60 @@ def test():
     rendered = render_string_template('{% call pow(2, x) %}', {"pow":pow, "x": 4})
     print rendered
 
+# a report table, the kind of loop-heavy template the compiled code is made for
+BENCHMARK_TEMPLATE = """<table>
+{% for row in rows %}<tr class="{% if it % 2 %}odd{% else %}even{% endif %}">
+{% for cell in row %}<td>{{cell}}</td>{% endfor %}
+<td>{% call total(row) %}</td>{% if row[0] > 500 %}<td>big</td>{% endif %}</tr>
+{% endfor %}</table>"""
+
+def benchmark(rows=1000, repeat=5):
+    tpl = Template(BENCHMARK_TEMPLATE)
+    tpl.compile()
+    context = {"rows": [[i, i * 2, "name %d" % i, i % 7] for i in range(rows)],
+               "total": lambda row: row[0] + row[1]}
+    results = []
+    for render in (tpl.render_nodes, tpl.render):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            render(Context(context))
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append(best * 1000)
+    print "%d rows: tree walking %.2f ms, compiled %.2f ms, %.1fx faster" % (
+        rows, results[0], results[1], results[0] / results[1])
+
+# a block of a list page, repeated to make templates of any size
+COMPILE_BENCHMARK_BLOCK = """<li class="{% if it % 2 %}odd{% else %}even{% endif %}">
+  {% for x in row %}<b>{{x}}</b>{% endfor %} {% call format(row, it) %}
+</li>
+"""
+
+# time to compile templates from 128KB to 1MB, which should double with the size
+def benchmark_compile(sizes=(128, 256, 512, 1024)):
+    print "%8s %8s %12s %12s %10s" % ("size", "tags", "parse (ms)", "total (ms)", "us per KB")
+    for kb in sizes:
+        template = COMPILE_BENCHMARK_BLOCK * (kb * 1024 // len(COMPILE_BENCHMARK_BLOCK))
+        tpl = Template(template)
+        start = time.time()
+        tpl.compile()
+        total = time.time() - start
+        # tokenizing and parsing again, without generating the code
+        start = time.time()
+        tpl._tokenize()
+        tpl.cursor = 0
+        while tpl.cursor < len(tpl.tokens):
+            tpl._get_next_node()
+        parse = time.time() - start
+        tags = sum(1 for token in tpl.tokens if token[0][:2] in ("{{", "{%"))
+        print "%6dKB %8d %12.1f %12.1f %10.1f" % (kb, tags, parse * 1000, total * 1000, total * 1e6 / kb)
+
 if __name__=="__main__":
-    test()
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+        benchmark_compile()
+    else:
+        test()
     
     
@@ -0,0 +1,203 @@
+"""
+Logging off the request path: records are appended to an in-memory ring, which a
+background thread formats and writes to the log file in batches.
+
+Appending to the ring takes no lock (deque.append is atomic), and when the ring is
+full the record is dropped and counted, so a slow disk or terminal never stalls a
+request. Files are opened with O_APPEND and each batch is written with a single
+write, so processes of a prefork server can share a log file.
+"""
+import os
+import sys
+import time
+import json
+import atexit
+import threading
+import collections
+
+# Apache combined log format, followed by the response time in seconds
+def format_combined(record):
+    t, client, verb, path, version, status, size, latency, referer, agent = record
+    return '%s - - [%s] "%s %s %s" %s %s "%s" "%s" %.6f\n' % (
+        client, time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(t)),
+        verb, path, version, status or "-", size or "-", referer or "-", agent or "-", latency)
+
+def format_json(record):
+    t, client, verb, path, version, status, size, latency, referer, agent = record
+    entry = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t)),
+        "client": client, "method": verb, "path": path, "protocol": version,
+        "status": status, "bytes": size, "latency": round(latency, 6),
+        "referer": referer, "user_agent": agent,
+    }
+    # paths aren't always utf-8
+    return json.dumps(entry, encoding="latin-1") + "\n"
+
+# the format of error records, which are (time, message, level)
+def format_text(record):
+    t, message, level = record
+    return "[%s] [%s] %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), level, message)
+
+FORMATS = {
+    "combined": format_combined,
+    "json": format_json,
+    "text": format_text,
+}
+
+class LogWriter(object):
+    # path "-" writes to stdout. The file is rotated when it reaches max_bytes, and
+    # every rotate_interval seconds, keeping backups old files as path.1, path.2 ...
+    def __init__(self, path="-", format="combined", buffer_records=16384, max_bytes=0,
+                 rotate_interval=0, backups=5, flush_interval=0.25, batch_bytes=65536):
+        if format not in FORMATS:
+            raise ValueError("Unknown log format: %s"%format)
+        self.path = path
+        self.format = FORMATS[format]
+        self.capacity = buffer_records
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_bytes = batch_bytes
+        self.ring = collections.deque()
+        self.written = 0
+        self.dropped = 0
+        self.fd = None
+        self._reset()
+
+    # state that a forked child can't share with its parent
+    def _reset(self):
+        self.pid = os.getpid()
+        self.ring.clear()
+        self.lock = threading.Lock()
+        self.thread = None
+        if self.fd is not None and self.path != "-":
+            # the parent keeps writing to it, reopen in case it was rotated
+            os.close(self.fd)
+            self.fd = None
+
+    def log(self, record):
+        if self.pid != os.getpid():
+            # in a forked child, the records in the ring are the parent's
+            self._reset()
+        if len(self.ring) >= self.capacity:
+            self.dropped += 1
+            return
+        self.ring.append(record)
+        if self.thread is None:
+            self._start()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception, e:
+                sys.stderr.write("Fail to write log %s: %s\n"%(self.path, e))
+
+    # write out the records in the ring, called by the writer thread and before exiting
+    def flush(self):
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            ring = self.ring
+            while ring:
+                batch = []
+                size = 0
+                while ring and size < self.batch_bytes:
+                    try:
+                        line = self.format(ring.popleft())
+                    except (ValueError, UnicodeError):
+                        self.dropped += 1
+                        continue
+                    batch.append(line)
+                    size += len(line)
+                self._write("".join(batch))
+                self.written += len(batch)
+
+    def _write(self, data):
+        if self.fd is None:
+            self._open()
+        elif self.path != "-":
+            now = time.time()
+            if ((self.max_bytes and self.size >= self.max_bytes) or
+                    (self.rotate_interval and int(now // self.rotate_interval) != self.period)):
+                self._rotate()
+            elif self._replaced():
+                self._open()
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+            self.size += written
+
+    def _open(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        if self.path == "-":
+            self.fd = sys.stdout.fileno()
+            self.size = self.ino = 0
+        else:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            st = os.fstat(self.fd)
+            self.size, self.ino = st.st_size, st.st_ino
+        if self.rotate_interval:
+            self.period = int(time.time() // self.rotate_interval)
+
+    # the file was rotated by another process, or by logrotate
+    def _replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self.ino
+        except OSError:
+            return True
+
+    def _rotate(self):
+        # another process sharing the file may have rotated it already
+        if not self._replaced():
+            if self.backups:
+                for i in range(self.backups - 1, 0, -1):
+                    src = "%s.%d"%(self.path, i)
+                    if os.path.exists(src):
+                        os.rename(src, "%s.%d"%(self.path, i + 1))
+                os.rename(self.path, self.path + ".1")
+            else:
+                os.unlink(self.path)
+        self._open()
+
+    def stats(self):
+        return {"written": self.written, "dropped": self.dropped, "pending": len(self.ring)}
+
+access_log = LogWriter("-", "combined")
+error_log = LogWriter("-", "text")
+
+def configure(access=None, error=None):
+    global access_log, error_log
+    flush()
+    if access is not None:
+        access_log = LogWriter(**access)
+    if error is not None:
+        error.setdefault("format", "text")
+        error_log = LogWriter(**error)
+
+def log_request(client, verb, path, version, status, size, latency, referer=None, agent=None):
+    access_log.log((time.time(), client, verb, path, version, status, size, latency, referer, agent))
+
+# the error log takes the server's other messages too, with level "INFO"
+def log_error(message, level="ERROR"):
+    error_log.log((time.time(), message, level))
+
+def flush():
+    for writer in (error_log, access_log):
+        try:
+            writer.flush()
+        except Exception:
+            pass
+
+atexit.register(flush)
@@ -0,0 +1,514 @@
+"""
+Benchmarks for the web server, run from this directory:
+
+    python benchmark.py router      # route lookup: the segment tree Mux against a linear scan
+    python benchmark.py metrics     # cost of recording the metrics of a request
+    python benchmark.py parser      # request head parsing against mimetools.Message
+    python benchmark.py load        # requests/s and latency of a running server, see load -h
+"""
+import os
+import sys
+import json
+import time
+import errno
+import random
+import signal
+import socket
+import shutil
+import timeit
+import argparse
+import tempfile
+import threading
+import mimetools
+import StringIO
+import subprocess
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import web_server
+import metrics
+import request_parser
+
+# The former Mux, scanning the routes sorted longest prefix first, kept as a baseline
+class LinearMux(object):
+    def __init__(self):
+        self.dict = {}
+        self.sortedkeys = []
+
+    def register_handler(self, path, handler):
+        self.dict[path] = handler
+        idx = -1
+        for i, key in enumerate(self.sortedkeys):
+            if path.startswith(key):
+                idx = i
+                break
+        if idx < 0:
+            self.sortedkeys.append(path)
+        else:
+            self.sortedkeys.insert(idx, path)
+
+    def get_handler(self, path):
+        for key in self.sortedkeys:
+            if path.startswith(key):
+                return self.dict[key]
+        return None
+
+def make_routes(count):
+    # services with a few nested routes each, like a typical api gateway config
+    routes = []
+    i = 0
+    while len(routes) < count:
+        base = "/service%d" % i
+        routes.extend([base, base + "/api", base + "/api/v1/items", base + "/static"])
+        i += 1
+    return routes[:count]
+
+def bench_router(counts=(10, 100, 500), lookups=10000):
+    print "%8s %14s %14s %8s" % ("routes", "linear (us)", "tree (us)", "speedup")
+    for count in counts:
+        routes = make_routes(count)
+        linear, tree = LinearMux(), web_server.Mux()
+        for path in routes:
+            linear.register_handler(path, path)
+            tree.register_handler(path, path)
+        rand = random.Random(count)
+        paths = [rand.choice(routes) + "/some/file.css" for i in range(lookups)]
+        paths += ["/missing/path/%d" % i for i in range(lookups // 10)]
+        def run(mux):
+            get_handler = mux.get_handler
+            for path in paths:
+                get_handler(path)
+        results = []
+        for mux in (linear, tree):
+            best = min(timeit.repeat(lambda: run(mux), number=1, repeat=3))
+            results.append(best / len(paths) * 1e6)
+        print "%8d %14.2f %14.2f %7.1fx" % (count, results[0], results[1], results[0] / results[1])
+
+def bench_metrics(requests=200000):
+    route = metrics.Registry().route("/bench")
+    rand = random.Random(0)
+    latencies = [rand.expovariate(1000.0) for i in range(1000)]
+    statuses = [200] * 9 + [404]
+    def run():
+        for i in xrange(requests):
+            route.in_flight += 1
+            route.finish(statuses[i % 10], 0, 4096, latencies[i % 1000])
+    def baseline():
+        for i in xrange(requests):
+            statuses[i % 10], latencies[i % 1000]
+    best = min(timeit.repeat(run, number=1, repeat=3))
+    loop = min(timeit.repeat(baseline, number=1, repeat=3))
+    print "recording a request: %.3f us" % ((best - loop) / requests * 1e6)
+    print "p50 %.6f  p99 %.6f  p999 %.6f" % tuple(route.latency.percentile(p) for p in (50, 99, 99.9))
+
+# a request head as sent by a browser
+BROWSER_HEAD = "\r\n".join([
+    "GET /static/css/site.css?v=3 HTTP/1.1",
+    "Host: www.example.com",
+    "Connection: keep-alive",
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept: text/css,*/*;q=0.1",
+    "Referer: https://www.example.com/index.html",
+    "Accept-Encoding: gzip, deflate, br",
+    "Accept-Language: en-US,en;q=0.9",
+    "Cookie: session=8f2d6c1b9e; theme=dark",
+    "If-None-Match: \"ce800b-6-65e1f566611e5\"",
+    "If-Modified-Since: Sun, 18 Oct 2026 15:49:06 GMT",
+])
+
+# what the server did before request_parser: split the request line, then mimetools
+def parse_with_mimetools(head):
+    request_line, _, rest = head.partition("\r\n")
+    verb, path, version = request_line.split()
+    headers = mimetools.Message(StringIO.StringIO(rest + "\r\n\r\n"), 0)
+    return verb, path, version, headers
+
+def bench_parser(requests=20000):
+    results = []
+    for parse in (parse_with_mimetools, request_parser.parse_request):
+        def run():
+            for i in xrange(requests):
+                headers = parse(BROWSER_HEAD)[3]
+                headers.get("connection")
+                headers.get("If-None-Match")
+        best = min(timeit.repeat(run, number=1, repeat=3))
+        results.append(best / requests * 1e6)
+    print "%-16s %10s" % ("parser", "us/request")
+    print "%-16s %10.2f" % ("mimetools", results[0])
+    print "%-16s %10.2f" % ("request_parser", results[1])
+    print "speedup %.1fx" % (results[0] / results[1])
+
+# Load generation: web_server.py is started in a temporary directory with a generated
+# config, and each scenario requests one path of it from many connections at once
+
+# path requested by each scenario
+SCENARIOS = [
+    ("static_small", "/static/small.html"),
+    ("static_large", "/static/large.bin"),
+    ("listing", "/static/listing/"),
+    ("wsgi", "/app/hello"),
+    ("proxy", "/proxy/hello"),
+]
+
+WSGI_APP = """
+def application(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return ["Hello world!"]
+"""
+
+# the upstream of the proxy scenario, a keep-alive server answering any GET
+class StubUpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the response is written at once, and sent right away
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    body = "upstream says hello\n" * 10
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+class StubUpstream(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+# the directory of the server: config.json, the wsgi application and the static files
+def make_site(root, args, upstream_port):
+    static = os.path.join(root, "static")
+    listing = os.path.join(static, "listing")
+    os.makedirs(listing)
+    with open(os.path.join(static, "small.html"), "w") as f:
+        f.write("<p>small file</p>\n" * 64)
+    with open(os.path.join(static, "large.bin"), "wb") as f:
+        f.write(os.urandom(args.large_size))
+    for i in range(args.listing_size):
+        open(os.path.join(listing, "file%04d.txt" % i), "w").close()
+    app = os.path.join(root, "app.py")
+    with open(app, "w") as f:
+        f.write(WSGI_APP)
+    config = {
+        "server": {
+            "ip": "127.0.0.1",
+            "port": args.port,
+            "mode": args.mode,
+            "worker_mode": args.worker_mode,
+            "workers": args.workers,
+            # the connections are closed by the clients
+            "max_requests": 0,
+            "access_log": {"path": os.path.join(root, "access.log")},
+            "error_log": {"path": os.path.join(root, "error.log")},
+        },
+        "routes": {
+            "/static": {"type": "static", "dir": static},
+            "/app": {"type": "wsgi", "application": app},
+            "/proxy": {"type": "proxy", "proxyurl": "http://127.0.0.1:%d/" % upstream_port},
+        },
+    }
+    with open(os.path.join(root, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+def start_server(root, port):
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web_server.py")
+    with open(os.path.join(root, "server.out"), "w") as out:
+        proc = subprocess.Popen([sys.executable, server_path], cwd=root, stdout=out,
+                                stderr=subprocess.STDOUT)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("the server exited, see %s" % os.path.join(root, "server.out"))
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return proc
+        except socket.error:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("the server didn't start listening")
+
+def stop_server(proc):
+    proc.terminate()
+    deadline = time.time() + 5
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+class ResponseError(Exception):
+    pass
+
+# A connection of the load generator, sending GET requests one at a time and reading
+# the responses just enough to find their end
+class Client(object):
+    def __init__(self, address, keepalive):
+        self.address = address
+        self.keepalive = keepalive
+        self.sock = None
+        self.buf = ""
+        self.connections = 0
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.buf = ""
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ResponseError("connection closed by the server")
+        self.buf += data
+
+    def get(self, request):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, 30)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections += 1
+        self.sock.sendall(request)
+        status, size, close = self.read_response()
+        if close or not self.keepalive:
+            self.close()
+        return status, size
+
+    # (status, body size, whether the server closes the connection)
+    def read_response(self):
+        while True:
+            end = self.buf.find("\r\n\r\n")
+            if end >= 0:
+                break
+            self._recv()
+        head, self.buf = self.buf[:end], self.buf[end + 4:]
+        lines = head.split("\r\n")
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        close = headers.get("connection", "").lower() == "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            size = self.read_chunked()
+        elif "content-length" in headers:
+            size = int(headers["content-length"])
+            while len(self.buf) < size:
+                self._recv()
+            self.buf = self.buf[size:]
+        else:
+            # the body ends with the connection
+            try:
+                while True:
+                    self._recv()
+            except ResponseError:
+                pass
+            size, self.buf, close = len(self.buf), "", True
+        return status, size, close
+
+    def read_chunked(self):
+        size = 0
+        while True:
+            while "\r\n" not in self.buf:
+                self._recv()
+            line, self.buf = self.buf.split("\r\n", 1)
+            length = int(line.split(";")[0], 16)
+            while len(self.buf) < length + 2:
+                self._recv()
+            self.buf = self.buf[length + 2:]
+            size += length
+            if not length:
+                return size
+
+# Run by each load generating process: connections threads request the path until the
+# deadline, the results of the requests completed after start are put on the queue
+def generate_load(address, path, connections, keepalive, start, deadline, queue):
+    request = "GET %s HTTP/1.1\r\nHost: %s:%d\r\n%s\r\n" % (
+        path, address[0], address[1], "" if keepalive else "Connection: close\r\n")
+    latency = metrics.Histogram()
+    totals = {"requests": 0, "errors": 0, "bytes": 0, "connections": 0}
+    lock = threading.Lock()
+    def run():
+        client = Client(address, keepalive)
+        local = metrics.Histogram()
+        requests = errors = size = 0
+        while True:
+            t = time.time()
+            if t >= deadline:
+                break
+            try:
+                status, n = client.get(request)
+                ok = 200 <= status < 400
+            except (socket.error, ResponseError, ValueError, IndexError):
+                client.close()
+                ok, n = False, 0
+            done = time.time()
+            if t < start:
+                continue
+            if ok:
+                requests += 1
+                size += n
+                local.record(done - t)
+            else:
+                errors += 1
+        client.close()
+        with lock:
+            totals["requests"] += requests
+            totals["errors"] += errors
+            totals["bytes"] += size
+            totals["connections"] += client.connections
+            for i, count in enumerate(local.counts):
+                latency.counts[i] += count
+            latency.sum += local.sum
+    threads = [threading.Thread(target=run) for i in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    queue.put((totals, latency.counts, latency.sum))
+
+def run_scenario(args, path):
+    # the connections are spread over processes, a single python process can't keep
+    # up with the server
+    processes = max(1, min(args.processes, args.concurrency))
+    start = time.time() + 0.5 + args.warmup
+    deadline = start + args.duration
+    queue = multiprocessing.Queue()
+    workers = []
+    for i in range(processes):
+        connections = args.concurrency // processes + (1 if i < args.concurrency % processes else 0)
+        p = multiprocessing.Process(target=generate_load, args=(
+            ("127.0.0.1", args.port), path, connections, args.keepalive, start, deadline, queue))
+        p.start()
+        workers.append(p)
+    latency = metrics.Histogram()
+    totals = {"requests": 0, "errors": 0, "bytes": 0, "connections": 0}
+    for p in workers:
+        counts, hist, hist_sum = queue.get()
+        for key in totals:
+            totals[key] += counts[key]
+        for i, count in enumerate(hist):
+            latency.counts[i] += count
+        latency.sum += hist_sum
+    for p in workers:
+        p.join()
+    result = dict(totals)
+    result["path"] = path
+    result["requests_per_second"] = round(totals["requests"] / float(args.duration), 1)
+    result["mean_ms"] = round(latency.sum / totals["requests"] * 1000, 3) if totals["requests"] else 0
+    for name, p in (("p50_ms", 50), ("p90_ms", 90), ("p99_ms", 99), ("p999_ms", 99.9)):
+        result[name] = round(latency.percentile(p) * 1000, 3)
+    return result
+
+# the scenarios that got slower than in the baseline results by more than tolerance
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results["scenarios"].items()):
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        if result["requests_per_second"] < before["requests_per_second"] * (1 - tolerance):
+            regressions.append("%s: %.1f req/s, was %.1f" % (
+                name, result["requests_per_second"], before["requests_per_second"]))
+        if result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append("%s: p99 %.3f ms, was %.3f" % (name, result["p99_ms"], before["p99_ms"]))
+    return regressions
+
+def bench_load():
+    parser = argparse.ArgumentParser(prog="benchmark.py load",
+        description="Start web_server.py with a generated config and measure every scenario.")
+    parser.add_argument("--mode", default="epoll", help="serving mode (default epoll)")
+    parser.add_argument("--worker-mode", default="epoll", help="worker mode in prefork mode")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--port", type=int, default=0, help="default: a free port")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="connections (default 32)")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds not measured")
+    parser.add_argument("--no-keepalive", dest="keepalive", action="store_false",
+                        help="a new connection per request")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="load generating processes (default: number of cores)")
+    parser.add_argument("-s", "--scenarios", default=",".join(name for name, path in SCENARIOS),
+                        help="comma separated, among %(default)s")
+    parser.add_argument("--large-size", type=int, default=1 << 20, help="bytes of the large file")
+    parser.add_argument("--listing-size", type=int, default=200, help="files of the listed directory")
+    parser.add_argument("-o", "--output", help="write the results as json to this file, - for stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with, exits with "
+                        "status 2 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction req/s may drop and p99 grow before it is a regression")
+    args = parser.parse_args(sys.argv[2:])
+    paths = dict(SCENARIOS)
+    names = [name for name in args.scenarios.split(",") if name]
+    for name in names:
+        if name not in paths:
+            parser.error("unknown scenario %s" % name)
+    if not args.port:
+        args.port = free_port()
+
+    upstream = StubUpstream(("127.0.0.1", 0), StubUpstreamHandler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.daemon = True
+    thread.start()
+    root = tempfile.mkdtemp(prefix="webserver-bench-")
+    proc = None
+    results = {
+        "server": {"mode": args.mode, "worker_mode": args.worker_mode, "workers": args.workers},
+        "load": {"concurrency": args.concurrency, "keepalive": args.keepalive,
+                 "duration": args.duration, "processes": args.processes},
+        "scenarios": {},
+    }
+    try:
+        make_site(root, args, upstream.server_address[1])
+        proc = start_server(root, args.port)
+        out = sys.stderr if args.output == "-" else sys.stdout
+        out.write("%-14s %10s %8s %9s %9s %9s %9s\n" % (
+            "scenario", "req/s", "errors", "mean ms", "p50 ms", "p99 ms", "p999 ms"))
+        for name in names:
+            result = run_scenario(args, paths[name])
+            results["scenarios"][name] = result
+            out.write("%-14s %10.1f %8d %9.3f %9.3f %9.3f %9.3f\n" % (
+                name, result["requests_per_second"], result["errors"], result["mean_ms"],
+                result["p50_ms"], result["p99_ms"], result["p999_ms"]))
+            out.flush()
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        upstream.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for line in regressions:
+            sys.stderr.write("regression %s\n" % line)
+        if regressions:
+            raise SystemExit(2)
+
+BENCHMARKS = {
+    "router": bench_router,
+    "metrics": bench_metrics,
+    "parser": bench_parser,
+    "load": bench_load,
+}
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print "usage: python benchmark.py [%s]" % "|".join(sorted(BENCHMARKS))
+        raise SystemExit(1)
+    BENCHMARKS[sys.argv[1]]()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Request metrics per route: counters by status, requests in flight, bytes in and out,
+and latency histograms, rendered in the Prometheus text format.
+
+Recording is a handful of integer updates without a lock: an increment racing with
+another thread can rarely be lost under the GIL, which is fine for monitoring and
+keeps the cost of a request to a couple of attribute updates and one call. Totals
+are derived from the status counts and histogram buckets when rendering.
+"""
+import threading
+
+# Latency histogram with HDR-style buckets: values in microseconds, exact below 32us,
+# then 16 buckets per power of two, so any value is known within about 6%
+class Histogram(object):
+    SUB_BUCKETS = 16
+    SIZE = 512
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.sum = 0.0
+
+    def record(self, seconds):
+        v = int(seconds * 1000000)
+        if v < 32:
+            i = v if v > 0 else 0
+        else:
+            shift = v.bit_length() - 5
+            i = ((shift + 1) << 4) + (v >> shift) - 16
+            if i >= self.SIZE:
+                i = self.SIZE - 1
+        self.counts[i] += 1
+        self.sum += seconds
+
+    # the largest value counted in bucket i, in seconds
+    @classmethod
+    def bucket_limit(cls, i):
+        if i < 32:
+            return (i + 1) / 1000000.0
+        shift = (i >> 4) - 1
+        sub = (i & 15) + 16
+        return ((sub + 1) << shift) / 1000000.0
+
+    def percentile(self, p):
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = total * p / 100.0
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if n and seen >= rank:
+                return self.bucket_limit(i)
+        return self.bucket_limit(self.SIZE - 1)
+
+    # cumulative counts at each of the limits, for the prometheus buckets
+    def cumulative(self, limits):
+        counts = list(self.counts)
+        result = []
+        seen = 0
+        i = 0
+        for limit in limits:
+            while i < self.SIZE and self.bucket_limit(i) <= limit:
+                seen += counts[i]
+                i += 1
+            result.append(seen)
+        return result, seen + sum(counts[i:])
+
+class RouteMetrics(object):
+    __slots__ = ("route", "in_flight", "bytes_in", "bytes_out", "statuses", "latency")
+
+    def __init__(self, route):
+        self.route = route
+        self.in_flight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.statuses = {}
+        self.latency = Histogram()
+
+    def finish(self, status, bytes_in, bytes_out, seconds):
+        self.in_flight -= 1
+        statuses = self.statuses
+        if status in statuses:
+            statuses[status] += 1
+        else:
+            statuses[status] = 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        # Histogram.record inlined, this runs for every request
+        latency = self.latency
+        v = int(seconds * 1000000)
+        if v < 32:
+            i = v if v > 0 else 0
+        else:
+            shift = v.bit_length() - 5
+            i = ((shift + 1) << 4) + (v >> shift) - 16
+            if i >= 512:
+                i = 511
+        latency.counts[i] += 1
+        latency.sum += seconds
+
+# buckets of the exported histogram, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUANTILES = (("0.5", 50), ("0.99", 99), ("0.999", 99.9))
+
+class Registry(object):
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def route(self, path):
+        with self.lock:
+            if path not in self.routes:
+                self.routes[path] = RouteMetrics(path)
+            return self.routes[path]
+
+    def render(self):
+        lines = []
+        def family(name, kind, help):
+            lines.append("# HELP %s %s"%(name, help))
+            lines.append("# TYPE %s %s"%(name, kind))
+        routes = [(label(path), m) for path, m in sorted(self.routes.items())]
+        family("http_requests_total", "counter", "Requests answered, by route and status code.")
+        for route, m in routes:
+            for status, n in sorted(m.statuses.items()):
+                lines.append('http_requests_total{route="%s",code="%s"} %d'%(route, status, n))
+        family("http_requests_in_flight", "gauge", "Requests being handled.")
+        for route, m in routes:
+            lines.append('http_requests_in_flight{route="%s"} %d'%(route, m.in_flight))
+        family("http_request_bytes_total", "counter", "Bytes of request bodies received.")
+        for route, m in routes:
+            lines.append('http_request_bytes_total{route="%s"} %d'%(route, m.bytes_in))
+        family("http_response_bytes_total", "counter", "Bytes of response bodies sent.")
+        for route, m in routes:
+            lines.append('http_response_bytes_total{route="%s"} %d'%(route, m.bytes_out))
+        family("http_request_duration_seconds", "histogram", "Time to answer requests.")
+        for route, m in routes:
+            cumulative, total = m.latency.cumulative(BUCKETS)
+            for limit, n in zip(BUCKETS, cumulative):
+                lines.append('http_request_duration_seconds_bucket{route="%s",le="%s"} %d'%(route, limit, n))
+            lines.append('http_request_duration_seconds_bucket{route="%s",le="+Inf"} %d'%(route, total))
+            lines.append('http_request_duration_seconds_sum{route="%s"} %.6f'%(route, m.latency.sum))
+            lines.append('http_request_duration_seconds_count{route="%s"} %d'%(route, total))
+        family("http_request_duration_quantile_seconds", "gauge", "Latency percentiles, within 6%.")
+        for route, m in routes:
+            for quantile, p in QUANTILES:
+                lines.append('http_request_duration_quantile_seconds{route="%s",quantile="%s"} %.6f'
+                             %(route, quantile, m.latency.percentile(p)))
+        return "\n".join(lines) + "\n"
+
+def label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+registry = Registry()
@@ -0,0 +1,208 @@
+"""
+HTTP/1.x request parsing: the request line and headers are read into one buffer and
+parsed with a single split, instead of line by line with mimetools.Message.
+"""
+import socket
+import errno
+
+# limits on the request line and headers
+MAX_HEAD_SIZE = 65536
+MAX_HEADERS = 100
+
+class RequestParseError(Exception):
+    def __init__(self, code, reason):
+        Exception.__init__(self, reason)
+        self.code = code
+        self.reason = reason
+
+# Case-insensitive mapping of the request headers. Repeated headers are combined
+# into one comma separated value, items() keeps the name as the client sent it
+class Headers(object):
+    __slots__ = ("_items", "_index")
+
+    def __init__(self, items=(), index=None):
+        self._items = list(items)
+        if index is None:
+            index = {}
+            for name, value in self._items:
+                add_header(index, name.lower(), value)
+        self._index = index
+
+    def get(self, name, default=None):
+        return self._index.get(name.lower(), default)
+
+    def __getitem__(self, name):
+        return self._index[name.lower()]
+
+    def __contains__(self, name):
+        return name.lower() in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_all(self, name):
+        name = name.lower()
+        return [v for n, v in self._items if n.lower() == name]
+
+    def items(self):
+        seen = set()
+        result = []
+        for name, value in self._items:
+            key = name.lower()
+            if key not in seen:
+                seen.add(key)
+                result.append((name, self._index[key]))
+        return result
+
+    def keys(self):
+        return [name for name, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return "Headers(%r)" % self._items
+
+def add_header(index, key, value):
+    if key in index:
+        # cookies are the exception to joining with commas
+        index[key] += ("; " if key == "cookie" else ", ") + value
+    else:
+        index[key] = value
+
+# Position of the blank line ending the request head in buf, and its length.
+# Lines should end with CRLF, a bare LF is accepted too
+def find_head_end(buf, start=0):
+    crlf = buf.find("\r\n\r\n", start)
+    # only look for a bare LF blank line before the CRLF one, the earlier
+    # of the two ends the head
+    lf = buf.find("\n\n", start, crlf if crlf >= 0 else len(buf))
+    if lf >= 0:
+        return lf, 2
+    if crlf >= 0:
+        return crlf, 4
+    return -1, 0
+
+# Parse a request head, without the blank line ending it, into
+# (method, path, version, headers)
+def parse_request(head):
+    if len(head) > MAX_HEAD_SIZE:
+        raise RequestParseError(431, "Request Header Fields Too Large")
+    lines = head.splitlines()
+    words = lines[0].split() if lines else []
+    if len(words) != 3 or not words[2].startswith("HTTP/"):
+        raise RequestParseError(400, "Invalid HTTP request")
+    if len(lines) > MAX_HEADERS + 1:
+        raise RequestParseError(431, "Request Header Fields Too Large")
+    items = []
+    index = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line[0] in " \t":
+            # obsolete line folding, continues the previous header
+            if not items:
+                raise RequestParseError(400, "Invalid header folding")
+            name, value = items.pop()
+            value = value + " " + line.strip()
+            items.append((name, value))
+            # combine again from scratch, rare enough
+            index = {}
+            for n, v in items:
+                add_header(index, n.lower(), v)
+            continue
+        name, sep, value = line.partition(":")
+        if not sep or not name or name[-1] in " \t":
+            raise RequestParseError(400, "Invalid header line")
+        value = value.strip()
+        items.append((name, value))
+        key = name.lower()
+        if key in index:
+            add_header(index, key, value)
+        else:
+            index[key] = value
+    return words[0], words[1], words[2], Headers(items, index)
+
+# Buffered reading of requests from a blocking socket: a request head is read with
+# as few recv calls as possible and found with one search of the buffer, the bytes
+# after it stay in the buffer for the body and the following requests
+class RequestReader(object):
+    def __init__(self, sock, bufsize=65536):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = ""
+
+    # the socket is closed by its owner
+    def close(self):
+        self.buf = ""
+
+    def _recv(self):
+        while True:
+            try:
+                return self.sock.recv(self.bufsize)
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    # the next request head without its ending blank line, "" if the connection
+    # was closed before a request started
+    def read_head(self, max_size=MAX_HEAD_SIZE):
+        searched = 0
+        while True:
+            # skip the empty lines clients may send between requests
+            if self.buf[:1] in ("\r", "\n"):
+                self.buf = self.buf.lstrip("\r\n")
+                searched = 0
+            end, size = find_head_end(self.buf, max(0, searched - 3))
+            if end >= 0:
+                head = self.buf[:end]
+                self.buf = self.buf[end + size:]
+                return head
+            if len(self.buf) > max_size:
+                raise RequestParseError(431, "Request Header Fields Too Large")
+            searched = len(self.buf)
+            data = self._recv()
+            if not data:
+                if self.buf:
+                    raise RequestParseError(400, "Incomplete request")
+                return ""
+            self.buf += data
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self.buf]
+            self.buf = ""
+            while True:
+                data = self._recv()
+                if not data:
+                    return "".join(chunks)
+                chunks.append(data)
+        if len(self.buf) < size:
+            chunks = [self.buf]
+            have = len(self.buf)
+            while have < size:
+                data = self._recv()
+                if not data:
+                    break
+                chunks.append(data)
+                have += len(data)
+            self.buf = "".join(chunks)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        searched = 0
+        while True:
+            end = self.buf.find("\n", searched)
+            if end >= 0 and (size < 0 or end < size):
+                line, self.buf = self.buf[:end + 1], self.buf[end + 1:]
+                return line
+            if size >= 0 and len(self.buf) >= size:
+                line, self.buf = self.buf[:size], self.buf[size:]
+                return line
+            searched = len(self.buf)
+            data = self._recv()
+            if not data:
+                line, self.buf = self.buf, ""
+                return line
+            self.buf += data
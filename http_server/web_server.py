@@ -1,19 +1,58 @@
 import SocketServer, socket
-import mimetools, mimetypes
+import mimetypes
 import os
+import select
+import errno
+import threading
+import Queue
+import collections
 import imp
+import signal
+import multiprocessing
 import urlparse
 import time
-import shutil
 import json
 import sys
 import urllib
+import stat
+import email.utils
+import zlib
+import itertools
+import bisect
+import operator
+import hashlib
+import binascii
+import cgi
 import requests
-import copy
+import access_log
+import metrics
+import request_parser
 try:
     import cStringIO as StringIO
 except:
     import StringIO
+try:
+    from os import scandir
+except ImportError:
+    # python 2 has it as a package
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import ssl
+except ImportError:
+    # python built without openssl, TLS can't be configured
+    ssl = None
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, neither is epoll
+    fcntl = None
+# python 2 doesn't export SO_REUSEPORT, the option number is fixed on linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else None)
+# nor SSL_OP_NO_TICKET
+OP_NO_TICKET = getattr(ssl, "OP_NO_TICKET", 0x4000)
 
 # templates
 error_tpl = u"""
@@ -39,6 +78,42 @@ listing_tpl = u"""
         </body>
     </html>
 """
+
+# Parts of responses formatted once: error bodies and status lines, which only depend on
+# the status, and the Date header, which changes once per second.
+# The caches are bounded, wsgi applications can send any status
+SERVER_HEADER = "Server: Neo's HTTP Server\r\n"
+error_bodies = {}
+status_lines = {}
+_date_header = (0, "")
+
+# the encoded error page of a status, and its length
+def error_body(code, explanation):
+    key = (code, explanation)
+    cached = error_bodies.get(key)
+    if cached is None:
+        body = (error_tpl%(code, code, explanation)).encode("utf-8")
+        cached = (body, str(len(body)))
+        if len(error_bodies) < 256:
+            error_bodies[key] = cached
+    return cached
+
+def status_line(status):
+    line = status_lines.get(status)
+    if line is None:
+        line = "HTTP/1.1 %s\r\n"%status
+        if len(status_lines) < 256:
+            status_lines[status] = line
+    return line
+
+def date_header():
+    global _date_header
+    now = int(time.time())
+    if _date_header[0] != now:
+        # replaced as a whole, threads may race to format it
+        _date_header = (now, "Date: %s\r\n"%email.utils.formatdate(now, usegmt=True))
+    return _date_header[1]
+
 # Exceptions
 class WSGIFileNotFound(Exception):
     "Raised when wsgi file is not found in file system"
@@ -48,57 +123,368 @@ class StaticDirNotValid(Exception):
     "Raised when static dir is not found or is not a directory"
 class DuplicatePath(Exception):
     "Raised when defining duplicate path in configuration file"
+class ConfigError(Exception):
+    "Raised when the configuration file can't be read or is invalid"
+class ConnectionAborted(Exception):
+    "Raised when writing to a connection that has been closed by the event loop"
+
+# A mux to route HTTP path to correct handler.
+# Routes are kept in a tree with a node per path segment, a lookup walks the segments of the
+# request path once and returns the handler of the longest route it went through.
+# A "<name>" segment in a route matches any segment, which is passed to the handler.
+# Without such routes, the prefixes of the path are looked up in a dict instead, from the
+# longest: the walk allocates too much to be worth it for a handful of routes
+class RouteNode(object):
+    def __init__(self):
+        self.children = {}
+        # child matching any segment, and the name of the parameter it captures
+        self.param_child = None
+        self.param_name = None
+        self.handler = None
 
-# A mux to route HTTP path to correct handler
 class Mux(object):
     def __init__(self):
         self.dict = {}
-        self.sortedkeys = []
+        self.root = RouteNode()
+        # routes without parameters by their normalized path, "" for the root
+        self.literal = {}
+        self.longest = 0
+        self.has_params = False
 
     def register_handler(self, path, handler):
         # register a virutal path to a handler
         if path in self.dict:
             raise DuplicatePath()
+        node = self.root
+        normalized = []
+        for segment in path.split("/"):
+            if not segment:
+                continue
+            normalized.append("/" + segment)
+            if segment.startswith("<") and segment.endswith(">"):
+                self.has_params = True
+                name = segment[1:-1]
+                if node.param_child is None:
+                    node.param_child = RouteNode()
+                    node.param_name = name
+                elif node.param_name != name:
+                    raise DuplicatePath()
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+        if node.handler is not None:
+            # same route written differently, like "/app" and "/app/"
+            raise DuplicatePath()
+        node.handler = handler
         self.dict[path] = handler
-        idx = -1
-        for i, key in enumerate(self.sortedkeys):
-            if path.startswith(key):
-                idx = i
+        normalized = "".join(normalized)
+        self.literal[normalized] = handler
+        self.longest = max(self.longest, len(normalized))
+
+    # Returns (handler, prefix, params): prefix is the part of the path matched by the route,
+    # params the values of its "<name>" segments. handler is None when nothing matches
+    def match(self, path):
+        if not self.has_params:
+            if "?" in path:
+                path = path[:path.index("?")]
+            # paths with empty segments take the walk, which skips them
+            if path[:1] == "/" and "//" not in path:
+                get = self.literal.get
+                # no route is longer than the longest one
+                pos = len(path)
+                if pos > self.longest:
+                    pos = path.rfind("/", 0, self.longest + 1)
+                while pos >= 0:
+                    handler = get(path[:pos])
+                    if handler is not None:
+                        return handler, path[:pos], {}
+                    pos = path.rfind("/", 0, pos)
+                return None, None, None
+        parts = path.split("?", 1)[0].split("/")
+        count = len(parts)
+        # (segments consumed, handler, params) of the longest route found
+        best = None
+        # the walk prefers literal segments, the "<name>" alternatives are tried afterwards
+        pending = None
+        node, i, params = self.root, 0, None
+        while True:
+            while True:
+                if node.handler is not None and (best is None or i > best[0]):
+                    best = (i, node.handler, params)
+                while i < count and not parts[i]:
+                    # empty segments, from the leading slash or "//"
+                    i += 1
+                if i == count:
+                    break
+                segment = parts[i]
+                if node.param_child is not None:
+                    captured = dict(params) if params else {}
+                    captured[node.param_name] = segment
+                    if pending is None:
+                        pending = []
+                    pending.append((node.param_child, i + 1, captured))
+                node = node.children.get(segment)
+                if node is None:
+                    break
+                i += 1
+            if not pending:
                 break
-        if idx < 0:
-            self.sortedkeys.append(path)
-        else:
-            self.sortedkeys.insert(idx, path)
+            node, i, params = pending.pop()
+        if best is None:
+            return None, None, None
+        consumed, handler, params = best
+        params = dict((k, urllib.unquote(v)) for k, v in params.items()) if params else {}
+        return handler, "/".join(parts[:consumed]), params
 
     def get_handler(self, path):
-        for key in self.sortedkeys:
-            if path.startswith(key):
-                return self.dict[key]
+        return self.match(path)[0]
+
+    def items(self):
+        return self.dict.items()
+
+# A mapping bounded by the total size of its values, evicting the least recently used ones
+class LRUCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # validate, if given, is called with the value and returns False when it is stale
+    def get(self, key, validate=None):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            # re-insert as the most recently used
+            self.entries[key] = item
+            if validate is None:
+                self.hits += 1
+                return item[0]
+        # validating may stat a file, not under the lock
+        fresh = validate(item[0])
+        with self.lock:
+            if fresh:
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            # unless another thread replaced it meanwhile
+            if self.entries.get(key) is item:
+                del self.entries[key]
+                self.size -= item[1]
+        return None
+
+    # the value of key without counting a lookup or making it recently used
+    def peek(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+        return item[0] if item is not None else None
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / lookups if lookups else 0.0,
+        }
+
+# Caps the requests handled at once. Requests over the cap wait, at most max_queue of
+# them and for at most queue_timeout seconds, further ones are turned away.
+# Threads wait in acquire(), the event loop registers a callback with acquire_async()
+class ConcurrencyLimit(object):
+    def __init__(self, max_concurrent, max_queue=None, queue_timeout=5):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_concurrent if max_queue is None else max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.lock = threading.Lock()
+        self.freed = threading.Condition(self.lock)
+        # threads blocked in acquire, and (deadline, callback) of the event loop
+        self.waiting = 0
+        self.waiters = collections.deque()
+        self.rejected = 0
+
+    def _queue_full(self):
+        if self.waiting + len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self.lock:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return True
+            if self._queue_full():
+                return False
+            deadline = time.time() + self.queue_timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self.freed.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    # True or False when decided right away, None when queued: callback(granted) is
+    # then called, from the thread releasing a slot or running expire()
+    def acquire_async(self, callback):
+        with self.lock:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return True
+            if self._queue_full():
+                return False
+            self.waiters.append((time.time() + self.queue_timeout, callback))
+            return None
+
+    def release(self):
+        granted = None
+        with self.lock:
+            self.active -= 1
+            expired = self._pop_expired()
+            if self.waiters:
+                # hand the slot over
+                granted = self.waiters.popleft()[1]
+                self.active += 1
+            else:
+                self.freed.notify()
+        for callback in expired:
+            callback(False)
+        if granted is not None:
+            granted(True)
+
+    def _pop_expired(self):
+        # all waiters wait as long, the oldest are first
+        now = time.time()
+        expired = []
+        while self.waiters and self.waiters[0][0] <= now:
+            expired.append(self.waiters.popleft()[1])
+        self.rejected += len(expired)
+        return expired
+
+    # turn away the queued callbacks past their deadline
+    def expire(self):
+        with self.lock:
+            expired = self._pop_expired()
+        for callback in expired:
+            callback(False)
+
+    def stats(self):
+        return {"active": self.active, "waiting": self.waiting + len(self.waiters),
+                "rejected": self.rejected}
+
+# a ConcurrencyLimit from the max_concurrent, max_queue and queue_timeout of a config section
+def make_limit(config):
+    if not config.get("max_concurrent"):
         return None
+    return ConcurrencyLimit(config["max_concurrent"], config.get("max_queue"),
+                            config.get("queue_timeout", 5))
+
+# The server side SSL context of the tls section of the config: certificate chain and key,
+# ciphers, session resumption and the protocols offered with ALPN.
+# Sessions are resumed with tickets, and from the cache of each process
+def make_ssl_context(config):
+    if ssl is None or not hasattr(ssl, "SSLContext"):
+        raise ValueError("TLS needs python 2.7.9 or later, built with ssl")
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | getattr(ssl, "OP_NO_COMPRESSION", 0)
+    context.options |= getattr(ssl, "OP_CIPHER_SERVER_PREFERENCE", 0)
+    context.load_cert_chain(config["cert"], config.get("key"))
+    if config.get("ciphers"):
+        context.set_ciphers(config["ciphers"])
+    if not config.get("session_tickets", True):
+        context.options |= OP_NO_TICKET
+    if getattr(ssl, "HAS_ALPN", False):
+        context.set_alpn_protocols(config.get("alpn", ["http/1.1"]))
+    return context
 
 # global mux object
 mux = Mux()
 
 # the main server
 class WebServer(object):
+    CONFIG_FILE = "config.json"
+
     # configuration is a json file
-    def _read_config(self):
+    def _load_config(self):
         try:
-            f = open("config.json", 'r')
+            f = open(self.CONFIG_FILE, 'r')
         except:
-            add_error_log("Fail to read config file, exiting now ...")
-            raise SystemExit()
+            raise ConfigError("Fail to read config file")
         try:
-            config = json.load(f)       
+            return json.load(f)
         except ValueError:
-            add_error_log("Fail to parse config file, exiting now...")
-            raise SystemExit()
+            raise ConfigError("Fail to parse config file")
+        finally:
+            f.close()
+
+    def _read_config(self):
+        config = self._load_config()
         try:
             self._address = config['server']['ip']
             self._port = config['server']["port"]
             self._mode = config['server']['mode']
         except KeyError:
             add_error_log("Missing server basic configuration, using defaults...")
+        server = config.get('server', {})
+        self._worker_threads = server.get("worker_threads", self._worker_threads)
+        self._worker_queue = server.get("worker_queue", self._worker_queue)
+        self._workers = server.get("workers", self._workers)
+        self._worker_mode = server.get("worker_mode", self._worker_mode)
+        self._graceful_timeout = server.get("graceful_timeout", self._graceful_timeout)
+        self._idle_timeout = server.get("idle_timeout", self._idle_timeout)
+        self._io_timeout = server.get("io_timeout", self._io_timeout)
+        self._max_requests = server.get("max_requests", self._max_requests)
+        self._max_body_size = server.get("max_body_size", self._max_body_size)
+        self._watch_interval = server.get("watch_config", self._watch_interval)
+        self.limit = make_limit(server)
+        self.retry_after = server.get("retry_after", self.retry_after)
+        self._max_connections = server.get("max_connections", self._max_connections)
+        if server.get("tls"):
+            try:
+                self.ssl_context = make_ssl_context(server["tls"])
+            except (KeyError, TypeError, ValueError, IOError), e:
+                raise ConfigError("Invalid tls configuration: %s"%str(e))
+        try:
+            access_log.configure(server.get("access_log"), server.get("error_log"))
+        except (TypeError, ValueError, OSError), e:
+            raise ConfigError("Invalid log configuration: %s"%str(e))
+        gzip = server.get("gzip")
+        if gzip is not None:
+            self.gzip = GzipEncoder(gzip.get("min_size", 1024), gzip.get("types"),
+                                    gzip.get("level", 6), gzip.get("cache_bytes", 32 << 20),
+                                    gzip.get("max_cached_size", 1 << 20))
         self._routes = config['routes']
 
     def __init__(self):
@@ -106,195 +492,982 @@ class WebServer(object):
         self._address = "127.0.0.1"
         self._port = 80
         self._mode = "thread"
-        # load from config
-        self._read_config()
-        # initialize the mux
-        for path in self._routes:
-            d = self._routes[path]
-            if d['type'] == "static":
-                try:
-                    handler = StaticHandler(path, d['dir'])
-                except StaticDirNotValid:
-                    add_error_log("Static directory in config file not valid, exiting...")
-                    raise SystemExit()
-            elif d['type'] == "wsgi":
-                try:
-                    handler = WSGIHandler(path, d['application'])
-                except WSGIInvalid, WSGIFileNotFound:
-                    handler = None
-                    add_error_log("WSGI file invalid, ignoring path %s"%path)
-            elif d['type'] =="proxy":
-                handler = ProxyHandler(path, d['proxyurl'])
-            else:
-                add_error_log("Unsupported path definition: %s"%path)
+        # worker pool running blocking handlers in epoll mode
+        self._worker_threads = 16
+        self._worker_queue = 256
+        # worker processes in prefork mode, each running a thread or epoll server
+        self._workers = multiprocessing.cpu_count()
+        self._worker_mode = "thread"
+        self._graceful_timeout = 30
+        # keep-alive: seconds to wait for the next request, and requests per connection
+        self._idle_timeout = 15
+        self._max_requests = 100
+        # thread and process modes: seconds a read of the body or a write of the response may block
+        self._io_timeout = 60
+        # larger request bodies get a 413, 0 for no limit
+        self._max_body_size = 100 << 20
+        # seconds between checks of config.json for changes, 0 to reload only on SIGHUP
+        self._watch_interval = 0
+        # concurrency limit of all the routes, and the Retry-After of requests turned away
+        self.limit = None
+        self.retry_after = 1
+        # connections served at once in thread mode, further ones get a 503 right away
+        self._max_connections = 0
+        # connections are accepted with TLS when set
+        self.ssl_context = None
+        # response compression, off unless configured
+        self.gzip = None
+        # the handler of each route, with the config it was created from
+        self._handlers = {}
+        self._reload_lock = threading.Lock()
+        # load from config, and initialize the mux
+        global mux
+        try:
+            self._read_config()
+            mux = self._build_mux(self._routes)
+        except ConfigError, e:
+            add_error_log("%s, exiting..."%str(e))
+            raise SystemExit()
+
+    # Create a Mux for the routes, reusing the handlers whose config didn't change.
+    # Raises ConfigError on invalid routes
+    def _build_mux(self, routes):
+        new_mux = Mux()
+        handlers = {}
+        for path in routes:
+            d = routes[path]
+            old = self._handlers.get(path)
+            if old is not None and old[0] == d:
+                new_mux.register_handler(path, old[1])
+                handlers[path] = old
+                continue
+            handler = self._create_handler(path, d)
+            if handler is None:
+                continue
             # link the handler and self
             handler.server = self
+            handler.metrics = metrics.registry.route(path)
+            handler.limit = make_limit(d)
             try:
-                mux.register_handler(path, handler)
+                new_mux.register_handler(path, handler)
             except DuplicatePath:
-                add_error_log("Config file contains duplicate path definition, exiting...")
-                raise SystemExit()
+                raise ConfigError("Config file contains duplicate path definition")
+            handlers[path] = (d, handler)
+        self._previous_handlers, self._handlers = self._handlers, handlers
+        return new_mux
 
-    def start(self):
+    def _create_handler(self, path, d):
+        handler = None
+        if d['type'] == "static":
+            try:
+                handler = StaticHandler(path, d['dir'], d.get('max_age'), d.get('cache'),
+                                        d.get('listing'))
+            except StaticDirNotValid:
+                raise ConfigError("Static directory in config file not valid")
+        elif d['type'] == "wsgi":
+            try:
+                handler = WSGIHandler(path, d['application'], d.get('flush_threshold', 8192))
+            except (WSGIInvalid, WSGIFileNotFound):
+                add_error_log("WSGI file invalid, ignoring path %s"%path)
+        elif d['type'] =="proxy":
+            try:
+                handler = ProxyHandler(path, d.get('upstreams') or d['proxyurl'], d.get('pool_size', 10),
+                                       d.get('connect_timeout', 5), d.get('read_timeout', 60),
+                                       d.get('balance', "round_robin"), d.get('max_fails', 3),
+                                       d.get('eject_time', 30), d.get('health_check'))
+            except ValueError, e:
+                raise ConfigError(str(e))
+        elif d['type'] == "stats":
+            handler = StatsHandler(path)
+        elif d['type'] == "metrics":
+            handler = MetricsHandler(path)
+        else:
+            add_error_log("Unsupported path definition: %s"%path)
+        return handler
+
+    # Re-read the routes of config.json and swap in a new mux. Requests in progress
+    # finish with the handlers they were routed to, unchanged routes keep their handler
+    # so wsgi applications aren't imported again. Server settings need a restart
+    def reload(self):
+        global mux
+        with self._reload_lock:
+            try:
+                routes = self._load_config()['routes']
+                new_mux = self._build_mux(routes)
+            except ConfigError, e:
+                add_error_log("Reloading config failed: %s, keeping the current routes"%str(e))
+                return False
+            except Exception, e:
+                add_error_log("Reloading config failed: %r, keeping the current routes"%e)
+                return False
+            mux = new_mux
+            # stop what the removed routes run in the background
+            current = set(id(handler) for d, handler in self._handlers.values())
+            for d, handler in self._previous_handlers.values():
+                if id(handler) not in current and hasattr(handler, "close"):
+                    handler.close()
+            self._previous_handlers = {}
+            add_info_log("Config reloaded, %d routes"%len(self._handlers))
+            return True
+
+    def _watch_config(self, on_change):
+        try:
+            mtime = os.stat(self.CONFIG_FILE).st_mtime
+        except OSError:
+            mtime = None
+        while True:
+            time.sleep(self._watch_interval)
+            try:
+                current = os.stat(self.CONFIG_FILE).st_mtime
+            except OSError:
+                continue
+            if current != mtime:
+                mtime = current
+                on_change()
+
+    # from a signal handler, importing wsgi applications may take a while
+    def _reload_in_background(self):
+        t = threading.Thread(target=self.reload)
+        t.daemon = True
+        t.start()
+
+    def _create_listener(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if SO_REUSEPORT is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            except socket.error:
+                pass
+        sock.bind((self._address, self._port))
+        sock.listen(EventLoopServer.request_queue_size)
+        return sock
+
+    # create the server for a serving mode, optionally on an already listening socket
+    def _make_server(self, mode, sock=None):
         address = (self._address, self._port)
-        if self._mode == "thread":
-            server = SocketServer.ThreadingTCPServer(address, HTTPServerHandler)
+        if mode == "epoll":
+            server = EventLoopServer(address, self._worker_threads, self._worker_queue, sock)
+        else:
+            if mode == "thread":
+                server_class = BoundedThreadingTCPServer
+            else:
+                server_class = SocketServer.ForkingTCPServer
+            if sock is None:
+                server = server_class(address, HTTPServerHandler)
+            else:
+                server = server_class(address, HTTPServerHandler, bind_and_activate=False)
+                server.socket.close()
+                server.socket = sock
+        server.idle_timeout = self._idle_timeout
+        server.io_timeout = self._io_timeout
+        server.max_requests = self._max_requests
+        server.max_body_size = self._max_body_size
+        server.max_connections = self._max_connections
+        server.retry_after = self.retry_after
+        server.ssl_context = self.ssl_context
+        return server
+
+    def start(self):
+        if self._mode == "prefork" and not hasattr(os, "fork"):
+            add_error_log("prefork is not available on this platform, using thread mode...")
+            self._mode = "thread"
+        for attr in ("_mode", "_worker_mode"):
+            if getattr(self, attr) == "epoll" and not hasattr(select, "epoll"):
+                add_error_log("epoll is not available on this platform, using thread mode...")
+                setattr(self, attr, "thread")
+        serving_mode = self._worker_mode if self._mode == "prefork" else self._mode
+        self.multithread = serving_mode in ("thread", "epoll")
+        self.multiprocess = self._mode in ("process", "prefork")
+        if self._mode == "prefork":
+            server = PreforkServer(self, self._create_listener(), self._workers,
+                                   self._worker_mode, self._graceful_timeout)
+            # the master reloads the config on SIGHUP, then replaces the workers
+            on_change = server.request_restart
         else:
-            server = SocketServer.ForkingTCPServer(address, HTTPServerHandler)
+            server = self._make_server(self._mode)
+            on_change = self.reload
+            if hasattr(signal, "SIGHUP"):
+                signal.signal(signal.SIGHUP, lambda signum, frame: self._reload_in_background())
+        if self._watch_interval:
+            t = threading.Thread(target=self._watch_config, args=(on_change,))
+            t.daemon = True
+            t.start()
         host, port = server.socket.getsockname()[:2]
         self.server_name = socket.getfqdn(host)
         self.server_port = port
         server.serve_forever()
 
+# gzip content negotiation and compression, for static and wsgi routes
+class GzipEncoder(object):
+    DEFAULT_TYPES = ["text/html", "text/plain", "text/css", "text/xml", "text/javascript",
+                     "application/javascript", "application/x-javascript", "application/json",
+                     "application/xml", "image/svg+xml"]
+
+    def __init__(self, min_size=1024, types=None, level=6, cache_bytes=32 << 20,
+                 max_cached_size=1 << 20):
+        # smaller responses are not worth compressing
+        self.min_size = min_size
+        self.types = set(types or self.DEFAULT_TYPES)
+        self.level = level
+        # compressed static files keyed by path, mtime and size
+        self.cache = LRUCache(cache_bytes)
+        self.max_cached_size = max_cached_size
+
+    def accepts(self, headers):
+        for part in headers.get("Accept-Encoding", "").split(","):
+            coding, _, params = part.partition(";")
+            if coding.strip().lower() not in ("gzip", "x-gzip", "*"):
+                continue
+            name, _, q = params.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    return float(q) > 0
+                except ValueError:
+                    return False
+            return True
+        return False
+
+    def compressible(self, content_type):
+        return content_type.split(";")[0].strip().lower() in self.types
+
+    def compressor(self):
+        # wbits of 16+MAX_WBITS writes the gzip header and trailer
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def is_cached(self, path, st):
+        return self.cache.peek((path, st.st_mtime, st.st_size)) is not None
+
+    def compress_file(self, path, st, f):
+        key = (path, st.st_mtime, st.st_size)
+        body = self.cache.get(key)
+        if body is None:
+            body = "".join(self.compress_stream(f))
+            self.cache.put(key, body, len(body))
+        return body
+
+    def compress_stream(self, chunks, bufsize=65536):
+        # chunks is an iterable of strings, or a file read bufsize at a time
+        if hasattr(chunks, "read"):
+            f = chunks
+            chunks = iter(lambda: f.read(bufsize), "")
+        compressor = self.compressor()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
 # implementation of handlers, each handler class should implement a handle_request(serv) method
 # For now, static handler only accept GET requests
 class StaticHandler(object):
-    def __init__(self, virtual_path, static_dir):
+    # blocking handlers are run on the worker pool in epoll mode, see blocks()
+    blocking = False
+    INDEX_FILES = ("index.html", "index.htm")
+
+    def __init__(self, virtual_path, static_dir, max_age=None, cache=None, listing=None):
         self.virtual_path = virtual_path
         self.static_dir = static_dir
+        # seconds browsers may use a file without revalidating it
+        self.max_age = max_age
         if not os.path.exists(static_dir) or not os.path.isdir(static_dir):
             raise StaticDirNotValid
+        # in-memory cache of small files, with their response headers
+        self.cache = None
+        if cache is not None:
+            self.cache = LRUCache(cache.get("max_bytes", 16 << 20))
+            self.cache_max_file_size = cache.get("max_file_size", 256 << 10)
+            # cached files are stat()ed at most once per check_interval seconds
+            self.cache_check_interval = cache.get("check_interval", 1)
+        # directory listings, rendered pages and scanned entries
+        listing = listing or {}
+        self.listings = LRUCache(listing.get("cache_bytes", 16 << 20))
+        self.listing_page_size = listing.get("page_size", 1000)
+
+    # What a request resolves to: its cached response if there's a fresh one, otherwise
+    # the stat of the file, the index file of a directory and the stat of a ".gz" sibling
+    def lookup(self, serv):
+        found = StaticLookup()
+        found.parsed = urlparse.urlparse(serv.path)
+        found.relative_path = found.parsed.path[len(serv.route_prefix):]
+        unquoted_path = urllib.unquote(found.relative_path)
+        found.real_path = self.static_dir + unquoted_path.decode(sys.getfilesystemencoding())
+        # gzip and identity responses of a file are cached separately
+        found.cache_key = (found.real_path, self.wants_gzip(serv, found.real_path))
+        if self.cache is not None and "Range" not in serv.headers:
+            found.cached = self.cache.get(found.cache_key, self.is_fresh)
+            if found.cached is not None:
+                return found
+        try:
+            found.st = os.stat(found.real_path)
+        except OSError:
+            return found
+        if stat.S_ISDIR(found.st.st_mode):
+            for index in self.INDEX_FILES:
+                if os.path.isfile(os.path.join(found.real_path, index)):
+                    found.index = index
+                    break
+        elif found.cache_key[1] and found.st.st_size >= self.server.gzip.min_size:
+            try:
+                found.gz_st = os.stat(found.real_path + ".gz")
+            except OSError:
+                pass
+        return found
+
+    # Whether the request needs a directory scan or a file compressed, which would stall
+    # the event loop. Cached responses and listings, and files sent as is stay on the loop.
+    # What was found is left on the request for handle_request
+    def blocks(self, serv):
+        if serv.verb.lower() != "get":
+            return False
+        try:
+            found = serv.static_lookup = self.lookup(serv)
+        except UnicodeError:
+            return True
+        st, real_path = found.st, found.real_path
+        if found.cached is not None or st is None:
+            return False
+        if stat.S_ISDIR(st.st_mode):
+            if found.index is not None:
+                return False
+            relative_path = found.relative_path
+            if not relative_path.endswith("/"):
+                relative_path = relative_path + "/"
+            key = self.listing_key(serv, real_path, relative_path, found.parsed.query)
+            cached = self.listings.peek(key)
+            return cached is None or cached[0] != st.st_mtime
+        gzip = self.server.gzip
+        if not found.cache_key[1] or st.st_size < gzip.min_size or gzip.is_cached(real_path, st):
+            return False
+        return found.gz_st is None or found.gz_st.st_mtime < st.st_mtime
 
     def handle_request(self, serv):
         if serv.verb.lower() != "get":
             serv.send_error_response(400, "Unsupported HTTP Method")
+            return
         # get the file system real path for the file/dir
-        parsed = urlparse.urlparse(serv.path)
-        relative_path = parsed.path[len(self.virtual_path):]
-        unquoted_path = urllib.unquote(relative_path)
-        real_path = self.static_dir + unquoted_path.decode(sys.getfilesystemencoding())
-       
-        if not os.path.exists(real_path):
+        found = getattr(serv, "static_lookup", None) or self.lookup(serv)
+        serv.static_lookup = None
+        parsed, relative_path, real_path = found.parsed, found.relative_path, found.real_path
+        cache_key = found.cache_key
+        if found.cached is not None:
+            self.serve_cached(serv, found.cached)
+            return
+
+        st = found.st
+        if st is None:
             serv.send_error_response(404, "File/directory not found.")
             return
         # handle differently for dir and file
-        if os.path.isdir(real_path):                      
-            # get the file listing
-            listing = os.listdir(real_path)
+        if stat.S_ISDIR(st.st_mode):
             if not relative_path.endswith("/"):
                 relative_path = relative_path + "/" 
 
             # first try index.html if exists
-            index_files = ["index.html", "index.htm"]
-            for index in index_files:
-                if index in listing:
-                    serv.send_response_line(302, "Redirected")
-                    index_path = os.path.join(self.virtual_path + relative_path, index)
-                    serv.send_header("Location", index_path)
-                    serv.end_headers()
-                    return
+            if found.index is not None:
+                serv.send_response_line(302, "Redirected")
+                index_path = os.path.join(serv.route_prefix + relative_path, found.index)
+                serv.send_header("Location", index_path)
+                serv.send_header("Content-Length", "0")
+                serv.end_headers()
+                return
 
-            # index.html not present, generate the listing html
-            # Send the response line and headers
+            # index.html not present, send the listing html
+            listing_html = self.directory_listing(serv, real_path, st, relative_path, parsed.query)
             serv.send_response_line(200, "OK") 
             serv.send_header("Content-Type", "text/html;charset=%s"%sys.getfilesystemencoding())
-            serv.send_header("Connection", "close")
-            # Construct HTML
-            listing_str = ""
-            if relative_path != "/":
-                # if not root, add parent directory link
-                parent_path = "/".join(relative_path.split("/")[:-2])
-                href = self.virtual_path + parent_path
-                line = u"<a href='%s'>..</a><br>"%href
-                listing_str += line
-            # construct the file list
-            for item in listing:
-                if isinstance(item, unicode):
-                    # decode to unicode
-                    stritem = item.encode(sys.getfilesystemencoding())
-                    unicodeitem = item
-                else:
-                    stritem = item
-                    unicodeitem = item.decode(sys.getfilesystemencoding())
-                # urllib.quote must be given str, not unicode
-                quoted_item = urllib.quote(stritem)
-                # construct url with quoted file name
-                href = os.path.join(self.virtual_path+relative_path, quoted_item)
-                snippet = u"<a href='%s'>%s</a><br>"%(href, unicodeitem)
-                listing_str += snippet
-
-            display_path = self.virtual_path+relative_path
-            listing_html = listing_tpl%(display_path, display_path, listing_str)
-            listing_html = listing_html.encode(sys.getfilesystemencoding())
             serv.send_header("Content-Length", len(listing_html))
             serv.end_headers() 
-            serv.wfile.write(listing_html)
+            serv.write(listing_html)
         else:
-            try:
-                f = open(real_path, "rb")
-            except:
-                serv.send_error_response(404, "File not found")
+            self.serve_file(serv, real_path, st, cache_key, found.gz_st)
+
+    # The cache key of a listing page, with the page asked in the query:
+    # sort=name|size|mtime, order=asc|desc, page=<n>, per_page=<n>
+    def listing_key(self, serv, real_path, relative_path, query):
+        params = urlparse.parse_qs(query)
+        sort = params.get("sort", ["name"])[0]
+        if sort not in ("name", "size", "mtime"):
+            sort = "name"
+        descending = params.get("order", ["asc"])[0] == "desc"
+        try:
+            per_page = max(1, min(int(params.get("per_page", [self.listing_page_size])[0]), 10000))
+            page = max(1, int(params.get("page", [1])[0]))
+        except ValueError:
+            per_page, page = self.listing_page_size, 1
+        display_path = serv.route_prefix + relative_path
+        return ("html", real_path, display_path, sort, descending, page, per_page)
+
+    # The encoded html listing a directory, a page of it sorted as asked in the query.
+    # Listings are cached until the directory is modified
+    def directory_listing(self, serv, real_path, st, relative_path, query):
+        key = self.listing_key(serv, real_path, relative_path, query)
+        fresh = lambda value: value[0] == st.st_mtime
+        cached = self.listings.get(key, fresh)
+        if cached is not None:
+            return cached[1]
+
+        display_path, sort, descending, page, per_page = key[2:]
+        entries = self.directory_entries(real_path, st, sort != "name")
+        if sort == "size":
+            entries = sorted(entries, key=lambda e: e[2])
+        elif sort == "mtime":
+            entries = sorted(entries, key=lambda e: e[3])
+        if descending:
+            entries = entries[::-1]
+        pages = max(1, (len(entries) + per_page - 1) // per_page)
+        page = min(page, pages)
+        rows = []
+        if relative_path != "/":
+            # if not root, add parent directory link
+            parent_path = "/".join(relative_path.split("/")[:-2])
+            rows.append(u"<a href='%s'>..</a><br>"%(serv.route_prefix + parent_path))
+        fs_encoding = sys.getfilesystemencoding()
+        # display_path comes from the url, already quoted
+        base = display_path
+        for entry in entries[(page - 1) * per_page:page * per_page]:
+            name, is_dir = entry[0], entry[1]
+            if is_dir is None:
+                # only the entries of the page are checked
+                is_dir = os.path.isdir(os.path.join(real_path, name))
+            if isinstance(name, unicode):
+                stritem, unicodeitem = name.encode(fs_encoding), name
+            else:
+                stritem, unicodeitem = name, name.decode(fs_encoding, "replace")
+            if is_dir:
+                stritem, unicodeitem = stritem + "/", unicodeitem + u"/"
+            # urllib.quote must be given str, not unicode
+            row = u"<a href='%s%s'>%s</a>"%(base, urllib.quote(stritem), cgi.escape(unicodeitem, True))
+            if sort != "name":
+                row += u" %d %s"%(entry[2], time.strftime("%Y-%m-%d %H:%M", time.localtime(entry[3])))
+            rows.append(row + u"<br>")
+        if pages > 1:
+            link = u"<a href='?sort=%s&order=%s&page=%%d&per_page=%d'>%%s</a>"%(
+                sort, "desc" if descending else "asc", per_page)
+            nav = [u"<hr>page %d of %d"%(page, pages)]
+            if page > 1:
+                nav.append(link%(page - 1, u"previous"))
+            if page < pages:
+                nav.append(link%(page + 1, u"next"))
+            rows.append(u" ".join(nav))
+        escaped_path = cgi.escape(display_path, True)
+        listing_html = listing_tpl%(escaped_path, escaped_path, u"\n".join(rows))
+        listing_html = listing_html.encode(fs_encoding, "replace")
+        self.listings.put(key, (st.st_mtime, listing_html), len(listing_html))
+        return listing_html
+
+    # The (name, is_dir, size, mtime) of the files in a directory, see scan_directory
+    def directory_entries(self, real_path, st, with_stat):
+        fresh = lambda value: value[0] == st.st_mtime
+        key = ("entries", real_path, with_stat)
+        cached = self.listings.get(key, fresh)
+        if cached is not None:
+            return cached[1]
+        entries = scan_directory(real_path, with_stat)
+        self.listings.put(key, (st.st_mtime, entries), sum(len(e[0]) + 64 for e in entries))
+        return entries
+
+    # the validators and caching headers of a file
+    def cache_headers(self, etag, last_modified, vary):
+        headers = [("ETag", etag), ("Last-Modified", last_modified)]
+        if self.max_age is not None:
+            headers.append(("Cache-Control", "max-age=%d"%self.max_age))
+        if vary:
+            headers.append(("Vary", "Accept-Encoding"))
+        return headers
+
+    def send_not_modified(self, serv, headers):
+        # the client's copy is still valid, no need to open the file
+        serv.send_response_line(304, "Not Modified")
+        for name, value in headers:
+            serv.send_header(name, value)
+        serv.end_headers()
+
+    # whether a gzip response should be sent, decided without touching the file system
+    def wants_gzip(self, serv, real_path):
+        gzip = self.server.gzip
+        return (gzip is not None and "Range" not in serv.headers
+                and gzip.compressible(guess_content_type(real_path))
+                and gzip.accepts(serv.headers))
+
+    # keep a small response in memory
+    def remember(self, cache_key, st, etag, headers, cache_headers, body):
+        if self.cache is not None and len(body) <= self.cache_max_file_size:
+            cached = CachedResponse(cache_key[0], st, etag, headers, cache_headers, body)
+            self.cache.put(cache_key, cached, len(body))
+
+    def serve_file(self, serv, real_path, st, cache_key, gz_st=None):
+        content_type = guess_content_type(real_path)
+        gzip = self.server.gzip
+        vary = gzip is not None and gzip.compressible(content_type)
+        if cache_key[1] and st.st_size >= gzip.min_size:
+            self.serve_gzip(serv, real_path, st, content_type, cache_key, gz_st)
+            return
+        etag = make_etag(st)
+        last_modified = timestamp_to_string(st.st_mtime)
+        cache_headers = self.cache_headers(etag, last_modified, vary)
+        if not is_modified(serv.headers, etag, st.st_mtime):
+            self.send_not_modified(serv, cache_headers)
+            return
+        try:
+            f = open(real_path, "rb")
+        except:
+            serv.send_error_response(404, "File not found")
+            return
+        try:
+            size = st.st_size
+            ranges = None
+            if "Range" in serv.headers and serv.headers.get("If-Range", etag) in (etag, last_modified):
+                ranges = parse_range_header(serv.headers["Range"], size)
+            if ranges == []:
+                serv.send_response_line(416, "Requested Range Not Satisfiable")
+                serv.send_header("Content-Range", "bytes */%d"%size)
+                serv.send_header("Content-Length", "0")
+                serv.end_headers()
                 return
-            serv.send_response_line(200, "OK") 
-            _, ext = os.path.splitext(real_path)
-            # ignore case of extension
-            ext = ext.lower() 
-            # make a guess based on mimetypes
-            content_type = mimetypes.types_map.get(ext, '')
-            if not content_type:
-                # default to text/html
-                content_type = "text/html"
-            serv.send_header("Content-Type", content_type)
-            # content-length and last-modified
-            stat = os.fstat(f.fileno())            
-            serv.send_header("Content-Length", str(stat.st_size))
-            serv.send_header("Last-Modified", timestamp_to_string(stat.st_mtime))
-            serv.send_header("Connection", "close")
+            if not ranges:
+                status = (200, "OK")
+                headers = [("Content-Type", content_type), ("Content-Length", str(size))]
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                status = (206, "Partial Content")
+                headers = [("Content-Type", content_type),
+                           ("Content-Range", "bytes %d-%d/%d"%(start, end, size)),
+                           ("Content-Length", str(end - start + 1))]
+            else:
+                # each range is sent as a part of a multipart body
+                # random, choose_boundary() would give away the host address and pid
+                boundary = binascii.hexlify(os.urandom(16))
+                part_heads = []
+                length = 0
+                for start, end in ranges:
+                    head = "\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"%(
+                            boundary, content_type, start, end, size)
+                    part_heads.append(head)
+                    length += len(head) + end - start + 1
+                tail = "\r\n--%s--\r\n"%boundary
+                length += len(tail)
+                status = (206, "Partial Content")
+                headers = [("Content-Type", "multipart/byteranges; boundary=%s"%boundary),
+                           ("Content-Length", str(length))]
+            headers.append(("Accept-Ranges", "bytes"))
+            headers.extend(cache_headers)
+            serv.send_response_line(*status)
+            for name, value in headers:
+                serv.send_header(name, value)
             serv.end_headers()
             # now copy the file over
-            shutil.copyfileobj(f, serv.wfile)
+            if not ranges:
+                if self.cache is not None and size <= self.cache_max_file_size:
+                    body = f.read(size)
+                    if len(body) == size:
+                        self.remember(cache_key, st, etag, headers, cache_headers, body)
+                    serv.write(body)
+                else:
+                    serv.send_file(f, 0, size)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                serv.send_file(f, start, end - start + 1)
+            else:
+                for head, (start, end) in zip(part_heads, ranges):
+                    serv.write(head)
+                    serv.send_file(f, start, end - start + 1)
+                serv.write(tail)
+        finally:
+            f.close()
+
+    # Send a gzip encoded file, from a precompressed ".gz" sibling when there's an up to date
+    # one (gz_st is its stat), otherwise compressed here. Compressed files are cached,
+    # except the big ones
+    def serve_gzip(self, serv, real_path, st, content_type, cache_key, gz_st):
+        gzip = self.server.gzip
+        if gz_st is not None and gz_st.st_mtime >= st.st_mtime:
+            source = real_path + ".gz"
+            etag = make_etag(gz_st)
+        else:
+            source = real_path
+            etag = make_etag(st)[:-1] + '-gzip"'
+        cache_headers = self.cache_headers(etag, timestamp_to_string(st.st_mtime), True)
+        if not is_modified(serv.headers, etag, st.st_mtime):
+            self.send_not_modified(serv, cache_headers)
+            return
+        try:
+            f = open(source, "rb")
+        except:
+            serv.send_error_response(404, "File not found")
+            return
+        try:
+            headers = [("Content-Type", content_type), ("Content-Encoding", "gzip")]
+            body = None
+            if source != real_path:
+                length = gz_st.st_size
+                if self.cache is not None and length <= self.cache_max_file_size:
+                    body = f.read(length)
+                headers.append(("Content-Length", str(length)))
+            elif st.st_size <= gzip.max_cached_size:
+                body = gzip.compress_file(real_path, st, f)
+                headers.append(("Content-Length", str(len(body))))
+            headers.extend(cache_headers)
+            serv.send_response_line(200, "OK")
+            for name, value in headers:
+                serv.send_header(name, value)
+            serv.end_headers()
+            if body is not None:
+                self.remember(cache_key, st, etag, headers, cache_headers, body)
+                serv.write(body)
+            elif source != real_path:
+                serv.send_file(f, 0, length)
+            else:
+                # too big to cache, compressed while it is sent
+                for chunk in gzip.compress_stream(f):
+                    serv.write(chunk)
+        finally:
+            f.close()
+
+    def is_fresh(self, cached):
+        now = time.time()
+        if now - cached.checked < self.cache_check_interval:
+            return True
+        try:
+            st = os.stat(cached.path)
+        except OSError:
+            return False
+        if (st.st_ino, st.st_size, st.st_mtime) != cached.identity:
+            return False
+        cached.checked = now
+        return True
+
+    def serve_cached(self, serv, cached):
+        if not is_modified(serv.headers, cached.etag, cached.mtime):
+            self.send_not_modified(serv, cached.cache_headers)
+            return
+        serv.send_response_line(200, "OK")
+        for name, value in cached.headers:
+            serv.send_header(name, value)
+        serv.end_headers()
+        serv.write(cached.body)
+
+# A static file response kept in memory by StaticHandler
+# What StaticHandler.lookup() found for a request
+class StaticLookup(object):
+    parsed = relative_path = real_path = cache_key = None
+    cached = None
+    st = index = gz_st = None
+
+class CachedResponse(object):
+    def __init__(self, path, st, etag, headers, cache_headers, body):
+        self.path = path
+        self.identity = (st.st_ino, st.st_size, st.st_mtime)
+        self.mtime = st.st_mtime
+        self.etag = etag
+        self.headers = headers
+        self.cache_headers = cache_headers
+        self.body = body
+        self.checked = time.time()
+
+# Reports the hit ratios of the static file and gzip caches as json
+class StatsHandler(object):
+    blocking = False
+
+    def __init__(self, virtual_path):
+        self.virtual_path = virtual_path
+
+    def handle_request(self, serv):
+        stats = {}
+        for path, handler in mux.items():
+            cache = getattr(handler, "cache", None)
+            if cache is not None:
+                stats[path] = cache.stats()
+        if self.server.gzip is not None:
+            stats["gzip"] = self.server.gzip.cache.stats()
+        stats["access_log"] = access_log.access_log.stats()
+        limits = dict((path, handler.limit.stats()) for path, handler in mux.items()
+                      if handler.limit is not None)
+        if self.server.limit is not None:
+            limits["server"] = self.server.limit.stats()
+        if limits:
+            stats["limits"] = limits
+        if self.server.ssl_context is not None:
+            stats["tls_sessions"] = self.server.ssl_context.session_stats()
+        body = json.dumps(stats, indent=2, sort_keys=True)
+        serv.send_response_line(200, "OK")
+        serv.send_header("Content-Type", "application/json")
+        serv.send_header("Content-Length", str(len(body)))
+        serv.end_headers()
+        serv.write(body)
+
+# Request metrics of all the routes, in the prometheus text format
+class MetricsHandler(object):
+    blocking = False
+
+    def __init__(self, virtual_path):
+        self.virtual_path = virtual_path
+
+    def handle_request(self, serv):
+        body = metrics.registry.render()
+        serv.send_response_line(200, "OK")
+        serv.send_header("Content-Type", "text/plain; version=0.0.4")
+        serv.send_header("Content-Length", str(len(body)))
+        serv.end_headers()
+        serv.write(body)
 
 class ProxyHandler(object):
-    def __init__(self, virtual_path, proxyurl):
+    blocking = True
+    # headers about a single connection, not forwarded
+    HOP_HEADERS = frozenset(["connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+                             "te", "trailers", "transfer-encoding", "upgrade"])
+    CHUNK_SIZE = 65536
+
+    def __init__(self, virtual_path, proxyurls, pool_size=10, connect_timeout=5, read_timeout=60,
+                 balance="round_robin", max_fails=3, eject_time=30, health_check=None):
         self.virtual_path = virtual_path
-        if proxyurl.endswith("/"):
-            self.proxyurl = proxyurl[:-1]
-        else:
-            self.proxyurl = proxyurl
+        if isinstance(proxyurls, basestring):
+            proxyurls = [proxyurls]
+        self.upstreams = UpstreamGroup(proxyurls, balance, max_fails, eject_time, health_check)
+        self.timeout = (connect_timeout, read_timeout)
+        # a session keeps up to pool_size connections to each upstream alive
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(proxyurls), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # only forward what the client sent, no default user agent or accept-encoding
+        self.session.headers.clear()
+
+    def forward_headers(self, serv, upstream):
+        skip = set(self.HOP_HEADERS)
+        # the Connection header can name more hop-by-hop headers
+        for name in serv.headers.get("Connection", "").split(","):
+            skip.add(name.strip().lower())
+        skip.update(["cookie", "host", "content-length"])
+        headers = {}
+        for name, value in serv.headers.items():
+            if name.lower() not in skip:
+                headers[name] = value
+        headers['Host'] = upstream.netloc
+        return headers
 
     def handle_request(self, serv):
         parsed = urlparse.urlparse(serv.path)
-        real_path = parsed.path[len(self.virtual_path):]
+        real_path = parsed.path[len(serv.route_prefix):]
         if not real_path.startswith("/"):
             real_path= "/" + real_path
-        real_url = self.proxyurl + real_path
-
-        headers = copy.copy(serv.headers)
-        del headers["Cookie"]
-        headers['Host'] = urlparse.urlparse(self.proxyurl).netloc
-
-        # Read the body of request
-        body = ""
-        if 'Content-Length' in headers and headers["Content-Length"]:
-            body = serv.rfile.read(int(headers["Content-Length"]))
-        print body
-        # use requests to do the dirty work
-        try:
-            response = requests.request(serv.verb.upper(), real_url, 
-                params=parsed.query, headers=headers, data=body,
-                allow_redirects=False)
-        except Exception, e:
-            add_error_log("Error when sending request to proxyurl:"+ str(e))
-            import traceback
-            print traceback.format_exc()
-            raise e
-        # just translate
+
+        # The body of request is streamed to the upstream as the client sends it,
+        # in epoll mode too. max_body_size applies as to any route
+        body = serv.rfile if serv.body_length else None
+        # a request without body can be retried on another upstream when the connection fails
+        attempts = 1 if body is not None else min(2, len(self.upstreams.upstreams))
+        tried = []
+        while True:
+            upstream = self.upstreams.choose(parsed.path, tried)
+            tried.append(upstream)
+            headers = self.forward_headers(serv, upstream)
+            # use requests to do the dirty work
+            upstream.acquire()
+            try:
+                response = self.session.request(serv.verb.upper(), upstream.url + real_path,
+                    params=parsed.query, headers=headers, data=body,
+                    allow_redirects=False, stream=True, timeout=self.timeout)
+            except requests.exceptions.RequestException, e:
+                upstream.release()
+                if isinstance(e, requests.exceptions.ConnectionError):
+                    self.upstreams.mark_failure(upstream)
+                    if len(tried) < attempts:
+                        continue
+                add_error_log("Error when sending request to %s: %s"%(upstream.url, str(e)))
+                if isinstance(e, requests.exceptions.Timeout):
+                    serv.send_error_response(504, "Gateway Timeout")
+                else:
+                    serv.send_error_response(502, "Bad Gateway")
+                return
+            break
+        self.upstreams.mark_success(upstream)
+        try:
+            self.relay_response(serv, response)
+        finally:
+            upstream.release()
+
+    # called when a config reload removes or replaces the route
+    def close(self):
+        self.upstreams.stop()
+
+    def relay_response(self, serv, response):
+        # just translate, the body is passed through as it is, still encoded
         serv.send_response_line(response.status_code, response.reason)
-        for header in response.headers:
-            # encoding has been handled by requests
-            if header.lower()=="content-encoding" or header.lower()=="transfer-encoding":
+        for header, value in response.raw.headers.items():
+            if header.lower() in self.HOP_HEADERS:
                 continue
-            serv.send_header(header, response.headers[header])
-        serv.send_header("Content-Length", len(response.content))
-
+            serv.send_header(header, value)
         serv.end_headers()
-        
-        serv.wfile.write(response.content)
+        try:
+            for chunk in response.raw.stream(self.CHUNK_SIZE, decode_content=False):
+                serv.write(chunk)
+        except:
+            # the connection to the upstream can't be reused
+            response.close()
+            raise
+        response.raw.release_conn()
+
+# An upstream server of a proxy route
+class Upstream(object):
+    def __init__(self, url):
+        self.url = url[:-1] if url.endswith("/") else url
+        self.netloc = urlparse.urlparse(self.url).netloc
+        # requests in progress, for least connections balancing
+        self.active = 0
+        self.lock = threading.Lock()
+        # consecutive failures, and until when the upstream is taken out of rotation
+        self.failures = 0
+        self.ejected_until = 0
+
+    def acquire(self):
+        with self.lock:
+            self.active += 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+# The upstreams of a proxy route: picks one per request with the balancing method,
+# and ejects the ones failing max_fails times in a row, for eject_time seconds or until
+# the periodic health check sees them healthy again
+class UpstreamGroup(object):
+    # points per upstream on the consistent hashing ring
+    HASH_REPLICAS = 100
+
+    def __init__(self, urls, balance="round_robin", max_fails=3, eject_time=30, health_check=None):
+        if balance not in ("round_robin", "least_conn", "hash"):
+            raise ValueError("Unknown balancing method: %s"%balance)
+        self.upstreams = [Upstream(url) for url in urls]
+        self.balance = balance
+        self.max_fails = max_fails
+        self.eject_time = eject_time
+        self.health_check = health_check
+        self.counter = itertools.count()
+        self.ring = []
+        for upstream in self.upstreams:
+            for i in range(self.HASH_REPLICAS):
+                self.ring.append((self._hash("%s#%d"%(upstream.url, i)), upstream))
+        self.ring.sort(key=lambda point: point[0])
+        self.ring_keys = [point[0] for point in self.ring]
+        # the process running the health check thread, threads don't survive a fork
+        self.checker_pid = None
+        self.checker_lock = threading.Lock()
+        self.stopped = False
+
+    def _hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def choose(self, path, exclude=()):
+        if self.health_check is not None and self.checker_pid != os.getpid():
+            self.start_health_check()
+        now = time.time()
+        candidates = [u for u in self.upstreams if u.ejected_until <= now and u not in exclude]
+        if not candidates:
+            # everything is down, try anyway rather than failing all requests
+            candidates = [u for u in self.upstreams if u not in exclude] or self.upstreams
+        if self.balance == "hash":
+            start = bisect.bisect(self.ring_keys, self._hash(path))
+            for i in range(len(self.ring)):
+                upstream = self.ring[(start + i) % len(self.ring)][1]
+                if upstream in candidates:
+                    return upstream
+        index = next(self.counter)
+        if self.balance == "least_conn":
+            # ties are broken in round robin order
+            n = len(candidates)
+            return min((candidates[(index + i) % n] for i in range(n)), key=lambda u: u.active)
+        return candidates[index % len(candidates)]
+
+    def mark_failure(self, upstream):
+        with upstream.lock:
+            upstream.failures += 1
+            if upstream.failures >= self.max_fails:
+                if upstream.ejected_until <= time.time():
+                    add_error_log("Upstream %s is down, ejecting it for %ds"%(upstream.url, self.eject_time))
+                upstream.ejected_until = time.time() + self.eject_time
+                upstream.failures = 0
+
+    def mark_success(self, upstream):
+        with upstream.lock:
+            upstream.failures = 0
+            upstream.ejected_until = 0
+
+    def start_health_check(self):
+        # requests race here on the first call in each process, only one starts the thread
+        with self.checker_lock:
+            if self.stopped or self.checker_pid == os.getpid():
+                return
+            t = threading.Thread(target=self._check_forever)
+            t.daemon = True
+            t.start()
+            self.checker_pid = os.getpid()
+
+    def _check_forever(self):
+        path = self.health_check.get("path", "/")
+        interval = self.health_check.get("interval", 10)
+        timeout = self.health_check.get("timeout", 2)
+        session = requests.Session()
+        while not self.stopped:
+            for upstream in self.upstreams:
+                try:
+                    response = session.get(upstream.url + path, timeout=timeout, allow_redirects=False)
+                    healthy = response.status_code < 500
+                except requests.exceptions.RequestException:
+                    healthy = False
+                if healthy:
+                    if upstream.ejected_until > time.time():
+                        add_info_log("Upstream %s is back"%upstream.url)
+                    self.mark_success(upstream)
+                else:
+                    self.mark_failure(upstream)
+            time.sleep(interval)
+
+    # the route was removed by a config reload
+    def stop(self):
+        self.stopped = True
+
+# A file-like view of a request body of known length, read from the connection stream.
+# It is the wsgi.input of wsgi apps, and is streamed to the upstream by proxies
+class RequestBodyReader(object):
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        # requests uses it for the Content-Length
+        self.len = length
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ""
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ""
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, "")
 
 
 class WSGIHandler(object):
-    def __init__(self, virtual_path, app_path):
+    blocking = True
+
+    def __init__(self, virtual_path, app_path, flush_threshold=8192):
         self.virtual_path = virtual_path
+        # small chunks of a response are gathered up to this size before being written
+        self.flush_threshold = flush_threshold
         self.load_application(app_path)
         
     def load_application(self, app_path):
@@ -323,25 +1496,21 @@ class WSGIHandler(object):
             
     def get_headers_environ(self, serv):
         headers_environ = {}
-        for key in serv.headers:
-            val = serv.headers[key]
-            if "-" in key:
-                key = key.replace("-", "_")
-            key = "HTTP_" + key.upper()
-            if key not in headers_environ:
+        # repeated headers are already combined by the parser
+        for key, val in serv.headers.items():
+            key = "HTTP_" + key.upper().replace("-", "_")
+            if key not in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
                 headers_environ[key] = val
-            else:
-                headers_environ[key] += "," + val
         return headers_environ
     
     def prepare_environ(self, serv):
         parsed = urlparse.urlparse(serv.path)
-        real_path = parsed.path[len(self.virtual_path):]
+        real_path = parsed.path[len(serv.route_prefix):]
         if not real_path.startswith("/"):
             real_path= "/" + real_path
         environ = {
             "REQUEST_METHOD":   serv.verb,
-            "SCRIPT_NAME":      self.virtual_path,
+            "SCRIPT_NAME":      serv.route_prefix,
             "PATH_INFO":        real_path,
             "QUERY_STRING":     parsed.query,
             "CONTENT_TYPE":     serv.headers.get("Content-Type", ""),
@@ -353,112 +1522,1442 @@ class WSGIHandler(object):
             "wsgi.errors":      serv.error,
             "wsgi.version":     (1,0),
             "wsgi.run_once":    False,
-            "wsgi.url_scheme":  "http", 
-            "wsgi.multithread":     self.server._mode=="thread",
-            "wsgi.multiprocess":    self.server._mode=="process", 
+            "wsgi.url_scheme":  serv.url_scheme,
+            "wsgi.multithread":     self.server.multithread,
+            "wsgi.multiprocess":    self.server.multiprocess, 
+            "wsgi.file_wrapper":    FileWrapper,
+            # values of the "<name>" segments of the route
+            "wsgiorg.routing_args": ((), serv.path_params),
         }
+        if serv.url_scheme == "https":
+            environ["HTTPS"] = "on"
         environ.update(self.get_headers_environ(serv))
         return environ
 
+    # compress the response if the client accepts gzip and the app didn't encode it
+    def should_compress(self, serv, status, response_headers):
+        gzip = self.server.gzip
+        if gzip is None or status[:3] in ("204", "304") or not gzip.accepts(serv.headers):
+            return False
+        headers = dict((k.lower(), v) for k, v in response_headers)
+        if "content-encoding" in headers or not gzip.compressible(headers.get("content-type", "")):
+            return False
+        try:
+            return int(headers.get("content-length", gzip.min_size)) >= gzip.min_size
+        except ValueError:
+            return False
+
     def handle_request(self, serv):
         # environ
         environ = self.prepare_environ(serv)
-        # start_response
-        def start_response(status, response_headers):
-            serv.send_status_line(status)
-            for k, v in response_headers:
-                serv.send_header(k, v)
-            serv.end_headers()
-        # Get response lines
+        response = WSGIResponse(self, serv, self.flush_threshold)
         try:
-            response_chucks = self.app(environ, start_response)
+            result = self.app(environ, response.start_response)
+            try:
+                if not isinstance(result, FileWrapper) or not response.send_file(result):
+                    response.set_length(result)
+                    for chunk in result:
+                        response.output(chunk)
+                response.finish()
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except socket.timeout:
+            # the client stalled reading or sending, no response, the connection is closed
+            raise
         except Exception as e:
             add_error_log("* ERROR IN WSGI APP *" + str(e))
-            raise e
+            if response.headers_sent:
+                # too late for an error response, the connection is closed
+                raise
+            serv.send_error_response(500, "Internal Server Error")
+
+# wsgi.file_wrapper: the server sends files returned this way with sendfile
+class FileWrapper(object):
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), "")
+
+# The response of a wsgi application: the start_response and write() callables, and
+# the output of the body iterable. Headers are sent with the first bytes of the body.
+# Chunks smaller than flush_threshold are gathered until that many bytes are waiting,
+# larger ones are written as they are
+class WSGIResponse(object):
+    def __init__(self, handler, serv, flush_threshold):
+        self.handler = handler
+        self.serv = serv
+        self.flush_threshold = flush_threshold
+        self.status = None
+        self.headers = None
+        self.headers_sent = False
+        self.compressor = None
+        self.buffer = []
+        self.buffered = 0
+
+    def start_response(self, status, response_headers, exc_info=None):
+        if exc_info is not None:
+            try:
+                if self.headers_sent:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError("start_response called twice without exc_info")
+        self.compressor = None
+        if self.handler.should_compress(self.serv, status, response_headers):
+            # the length is unknown until the body is compressed
+            response_headers = [(k, v) for k, v in response_headers
+                                if k.lower() != "content-length"]
+            response_headers.append(("Content-Encoding", "gzip"))
+            response_headers.append(("Vary", "Accept-Encoding"))
+            self.compressor = self.handler.server.gzip.compressor()
+        self.status = status
+        self.headers = list(response_headers)
+        return self.write
+
+    def has_header(self, name):
+        name = name.lower()
+        return any(k.lower() == name for k, v in self.headers)
+
+    # a body given as a list has a known length, which saves the chunked encoding
+    def set_length(self, result):
+        if (isinstance(result, (list, tuple)) and self.status is not None
+                and self.compressor is None and not self.has_header("Content-Length")):
+            self.headers.append(("Content-Length", str(sum(len(chunk) for chunk in result))))
+
+    def send_headers(self):
+        if self.status is None:
+            raise AssertionError("start_response was not called")
+        self.serv.send_status_line(self.status)
+        for k, v in self.headers:
+            self.serv.send_header(k, v)
+        self.serv.end_headers()
+        self.headers_sent = True
+
+    # the write() callable returned by start_response, the data is sent right away.
+    # The compressor keeps small writes to itself, a sync flush gets them out
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.output_compressed(data)
+        self.flush()
+
+    def output(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.output_compressed(data)
+
+    # buffer data that is already compressed if it has to be
+    def output_compressed(self, data):
+        if len(data) >= self.flush_threshold:
+            self.flush()
+            self.serv.write(data)
+        elif data:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= self.flush_threshold:
+                self.flush()
+
+    def flush(self):
+        if not self.headers_sent:
+            self.send_headers()
+        if self.buffer:
+            data = self.buffer[0] if len(self.buffer) == 1 else "".join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            self.serv.write(data)
+
+    def finish(self):
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.compressor = None
+            self.output_compressed(data)
+        self.flush()
+
+    # send a wsgi.file_wrapper of a regular file with sendfile, False if it's not one
+    def send_file(self, wrapper):
+        if self.status is None or self.compressor is not None:
+            return False
+        f = wrapper.filelike
+        try:
+            st = os.fstat(f.fileno())
+            offset = f.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        count = max(0, st.st_size - offset)
+        for k, v in self.headers:
+            if k.lower() == "content-length":
+                try:
+                    count = min(count, int(v))
+                except ValueError:
+                    return False
+                break
+        else:
+            self.headers.append(("Content-Length", str(count)))
+        self.flush()
+        # the application closes its file when the response is done
+        self.serv.send_file(f, offset, count)
+        return True
+
+# Request parsing and response writing shared by the threaded/forking handler and the event loop.
+# The class mixing it in provides self.wfile and self.error, and reads self.close_connection.
+# Responses without a Content-Length are sent chunked to HTTP/1.1 clients, and end the
+# connection otherwise, so that keep-alive connections always know where a response ends
+class HTTPResponseMixin(object):
+    # error responses after which the rest of the request can't be trusted
+    CLOSING_ERRORS = frozenset([400, 408, 411, 413, 431, 500])
+
+    # parse the request line and headers, raises request_parser.RequestParseError
+    def parse_request(self, head):
+        self.verb, self.path, self.version, self.headers = request_parser.parse_request(head)
+
+    # find the handler of the request path, and record the matched prefix and parameters
+    def route_request(self):
+        handler, self.route_prefix, self.path_params = mux.match(self.path)
+        if handler is not None:
+            self.metrics = handler.metrics
+        else:
+            self.metrics = metrics.registry.route("unmatched")
+        self.metrics.in_flight += 1
+        return handler
+
+    # HTTP/1.1 connections are persistent unless the client asks otherwise, HTTP/1.0 ones
+    # only when asked
+    def parse_connection_header(self):
+        tokens = [t.strip().lower() for t in self.headers.get("Connection", "").split(",")]
+        if "close" in tokens:
+            self.close_connection = True
+        elif "keep-alive" in tokens:
+            self.close_connection = False
         else:
-            for chuck in response_chucks:
-                serv.wfile.write(chuck)
+            self.close_connection = self.version != "HTTP/1.1"
+
+    # Length of the request body, None for chunked bodies which are not supported
+    def request_body_length(self):
+        if self.headers.get("Transfer-Encoding", "identity").lower() != "identity":
+            return None
+        return int(self.headers.get("Content-Length") or 0)
+
+    def reset_response(self):
+        self.status_code = None
+        self.length_known = False
+        self.chunked = False
+        self.connection_header_sent = False
+        self.body_allowed = True
+        self.bytes_sent = 0
+        # the response head, written at once by end_headers
+        self.head = None
+        self.server_header_sent = False
+        self.date_header_sent = False
+
+    # record the metrics of the route and log the request once it is answered
+    def request_done(self):
+        if self.metrics is None and self.status_code is None:
+            return
+        latency = time.time() - self.started
+        if self.metrics is not None:
+            self.metrics.finish(self.status_code or 0, self.body_length, self.bytes_sent, latency)
+            self.metrics = None
+        if self.status_code is not None:
+            headers = getattr(self, "headers", None) or {}
+            add_access_log(self.client_address[0], self.verb, self.path, self.version,
+                           self.status_code, self.bytes_sent, latency,
+                           headers.get("Referer"), headers.get("User-Agent"))
+
+    def log_request_errors(self):
+        # If the request handler write some error messages, record them in log
+        if self.error.tell():
+            self.error.seek(0)
+            add_error_log(self.error.read())
+            self.error.seek(0)
+            self.error.truncate()
+
+    def send_response_line(self, code, explanation):
+        self.send_status_line("%d %s"%(code, explanation))
+
+    def send_status_line(self, status):
+        self.reset_response()
+        self.status_code = int(status[:3])
+        self.head = [status_line(status)]
+
+    def send_header(self, name, value):
+        self.head.append("%s: %s\r\n"%(name, value))
+        name = name.lower()
+        if name == "connection":
+            self.connection_header_sent = True
+            if value.lower() == "close":
+                self.close_connection = True
+            elif value.lower() == "keep-alive":
+                self.close_connection = False
+        elif name == "content-length":
+            self.length_known = True
+        elif name == "transfer-encoding" and value.lower() == "chunked":
+            self.chunked = True
+        elif name == "date":
+            # a proxied response keeps the upstream's
+            self.date_header_sent = True
+        elif name == "server":
+            self.server_header_sent = True
+
+    def has_body(self):
+        return (self.verb.upper() != "HEAD" and self.status_code >= 200
+                and self.status_code not in (204, 304))
+
+    def end_headers(self):
+        # choose how the end of the body is marked
+        self.body_allowed = self.has_body()
+        if not self.length_known and not self.chunked and self.body_allowed:
+            if self.version == "HTTP/1.1":
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.close_connection = True
+        if not self.connection_header_sent:
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            elif self.version != "HTTP/1.1":
+                self.send_header("Connection", "keep-alive")
+        head = self.head
+        if not self.server_header_sent:
+            head.append(SERVER_HEADER)
+        if not self.date_header_sent:
+            head.append(date_header())
+        head.append("\r\n")
+        self.head = None
+        self.wfile.write("".join(head))
+
+    # write a piece of the response body
+    def write(self, data):
+        if not data or not self.body_allowed:
+            return
+        self.bytes_sent += len(data)
+        if self.chunked:
+            if len(data) < 65536:
+                self.wfile.write("%x\r\n%s\r\n"%(len(data), data))
+            else:
+                # not worth copying
+                self.wfile.write("%x\r\n"%len(data))
+                self.wfile.write(data)
+                self.wfile.write("\r\n")
+        else:
+            self.wfile.write(data)
+
+    # called once the handler is done with the response
+    def finish_response(self):
+        if self.chunked:
+            self.wfile.write("0\r\n\r\n")
+            self.chunked = False
+
+    # write count bytes of file f from offset as part of the body
+    def send_file(self, f, offset, count):
+        if count <= 0 or not self.body_allowed:
+            return
+        self.bytes_sent += count
+        if self.chunked:
+            self.wfile.write("%x\r\n"%count)
+            self.write_file(f, offset, count)
+            self.wfile.write("\r\n")
+        else:
+            self.write_file(f, offset, count)
+
+    # straight from the fd to the socket if possible
+    def write_file(self, f, offset, count):
+        self.wfile.flush()
+        if sendfile is None or self.url_scheme == "https":
+            # sendfile would bypass the encryption
+            copy_file_range(f, offset, count, self.wfile)
+            return
+        out_fd = self.connection.fileno()
+        started = False
+        while count > 0:
+            try:
+                sent = sendfile(out_fd, f.fileno(), offset, count)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    # socket with a timeout, wait for it to be writable
+                    if not select.select([], [out_fd], [], self.connection.gettimeout())[1]:
+                        raise socket.timeout("timed out")
+                    continue
+                if not started and e.errno in (errno.EINVAL, errno.ENOSYS):
+                    # the file system doesn't support sendfile
+                    copy_file_range(f, offset, count, self.wfile)
+                    return
+                raise
+            if sent == 0:
+                break
+            started = True
+            offset += sent
+            count -= sent
+        
+    # the concurrency limits a request to the handler must get a slot of, route first:
+    # waiting for a busy route mustn't hold a slot of the global limit
+    def request_limits(self, handler):
+        return [limit for limit in (handler.limit, handler.server.limit) if limit is not None]
+
+    # for the requests over the concurrency limits
+    def send_overloaded(self, handler):
+        self.send_error_response(503, "Service Unavailable",
+                                 [("Retry-After", str(handler.server.retry_after))])
+
+    def send_error_response(self, code, explanation, headers=()):
+        if code in self.CLOSING_ERRORS:
+            self.close_connection = True
+        message_body, length = error_body(code, explanation)
+        self.send_response_line(code, explanation)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", length)
+        self.end_headers()
+        self.write(message_body)
+        if not self.wfile.closed:
+            self.wfile.flush()
 
 # This is the handler entry point, dispatching requests to different handlers with the help of mux
-class HTTPServerHandler(SocketServer.StreamRequestHandler):
+class HTTPServerHandler(HTTPResponseMixin, SocketServer.StreamRequestHandler):
+    disable_nagle_algorithm = True
+    # unread request bodies up to this size are skipped to keep the connection
+    MAX_DISCARD = 65536
+
     def __init__(self, request, client_addr, server):
         self.error = StringIO.StringIO()
         SocketServer.StreamRequestHandler.__init__(self, request, client_addr, server)
+
+    def setup(self):
+        self.url_scheme = "http"
+        self.alpn_protocol = None
+        self.tls_failed = False
+        context = getattr(self.server, "ssl_context", None)
+        if context is not None:
+            # the handshake runs in the connection's thread or process, not the accepting one
+            self.request = context.wrap_socket(self.request, server_side=True,
+                                               do_handshake_on_connect=False)
+            self.url_scheme = "https"
+            try:
+                self.request.settimeout(getattr(self.server, "idle_timeout", 15))
+                self.request.do_handshake()
+                self.alpn_protocol = self.request.selected_alpn_protocol()
+            except socket.error:
+                # clients giving up, plain http, scanners... nothing worth logging
+                self.tls_failed = True
+        SocketServer.StreamRequestHandler.setup(self)
+        # requests are read from the connection stream, handlers get self.rfile bounded to the body
+        self.stream = request_parser.RequestReader(self.connection)
+        self.requests_handled = 0
+        self.idle_timeout = getattr(self.server, "idle_timeout", 15)
+        self.io_timeout = getattr(self.server, "io_timeout", 60)
+        self.max_requests = getattr(self.server, "max_requests", 100)
         
     # Should read the request from self.rfile
     # and write the response to self.wfile
     def handle_one_request(self):
         try:
-            # read the first line from request
-            request_line = self.rfile.readline()
-            words = request_line.strip().split()
-            if len(words) != 3:
-                self.send_error_response(400, "Invalid HTTP request")
+            # wait for the next request at most idle_timeout
+            self.connection.settimeout(self.idle_timeout)
+            self.status_code = None
+            self.metrics = None
+            self.started = time.time()
+            self.body_length = 0
+            self.verb = "GET"
+            self.path = "-"
+            self.version = "HTTP/1.0"
+            self.headers = None
+            self.reset_response()
+            # read the request line and headers
+            try:
+                head = self.stream.read_head()
+                if not head:
+                    # the client closed the connection
+                    self.close_connection = True
+                    return
+                self.started = time.time()
+                self.parse_request(head)
+            except request_parser.RequestParseError, e:
+                self.send_error_response(e.code, e.reason)
                 return
-            self.verb, self.path, _ = words
-            add_access_log(self.verb+" "+self.path)
-            # read the header lines
-            self.headers = mimetools.Message(self.rfile, 0)
-            connection_type = self.headers.get("Connection", "")
-            if connection_type == "close":
+            # a client stalling on its body or on the response is dropped after io_timeout
+            self.connection.settimeout(self.io_timeout)
+            self.parse_connection_header()
+            self.requests_handled += 1
+            if self.max_requests and self.requests_handled >= self.max_requests:
                 self.close_connection = True
-            elif connection_type == "keep-alive":
-                self.close_connection = False
+            try:
+                length = self.request_body_length()
+            except ValueError:
+                self.send_error_response(400, "Invalid Content-Length")
+                return
+            if length is None:
+                self.send_error_response(411, "Length Required")
+                return
+            max_body_size = getattr(self.server, "max_body_size", 0)
+            if max_body_size and length > max_body_size:
+                self.send_error_response(413, "Request Entity Too Large")
+                return
+            self.body_length = length
+            if length and self.headers.get("Expect", "").lower() == "100-continue":
+                self.wfile.write("HTTP/1.1 100 Continue\r\n\r\n")
+            self.rfile = RequestBodyReader(self.stream, length)
 
             # delegate body handling to mux
-            handler = mux.get_handler(self.path)
+            handler = self.route_request()
             if not handler:
                 self.send_error_response(404, "File Not Found")
-                return
-            handler.handle_request(self)
-            if not self.wfile.closed:
-                self.wfile.flush()
-                self.wfile.close()
-
-            # If the request handler write some error messages, record them in log
-            if self.error.tell():
-                self.error.seek(0)
-                add_error_log(self.error.read())
+            else:
+                limits = self.request_limits(handler)
+                acquired = []
+                for limit in limits:
+                    if not limit.acquire():
+                        break
+                    acquired.append(limit)
+                try:
+                    if len(acquired) < len(limits):
+                        self.send_overloaded(handler)
+                    else:
+                        handler.handle_request(self)
+                        self.finish_response()
+                finally:
+                    for limit in acquired:
+                        limit.release()
+            self.wfile.flush()
+            self.log_request_errors()
+            # skip what the handler didn't read of the body, the next request follows it
+            if self.rfile.remaining > self.MAX_DISCARD:
+                self.close_connection = True
+            elif self.rfile.remaining:
+                self.rfile.read()
+        except socket.timeout:
+            self.close_connection = True
         except Exception, e:
             add_error_log(str(e))
             self.close_connection = True
+        finally:
+            self.request_done()
                         
+    def finish(self):
+        self.rfile = self.stream
+        SocketServer.StreamRequestHandler.finish(self)
+        if self.url_scheme == "https" and not self.tls_failed:
+            shutdown_tls(self.connection)
+        if isinstance(self.server, SocketServer.ForkingMixIn):
+            # the child process exits right after
+            access_log.flush()
+
     def handle(self):
-        self.close_connection = True
-        self.handle_one_request()
-        # supporting keep-alive
+        self.close_connection = self.tls_failed
+        # supporting keep-alive, requests are answered in the order they were sent
         while not self.close_connection:
             self.handle_one_request()
 
-    def send_response_line(self, code, explanation):
-        self.send_status_line("%d %s"%(code, explanation))
+# Event loop serving mode: one thread multiplexes all the connections with epoll and parses
+# requests incrementally, handlers that may block (wsgi apps, proxying) run on a worker pool
+class WorkerPool(object):
+    def __init__(self, size, queue_size):
+        self.tasks = Queue.Queue(queue_size)
+        for i in range(size):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
 
-    def send_status_line(self, status):
-        response_line = "HTTP/1.1 %s\r\n"%status
-        self.wfile.write(response_line)
-        self.send_header("Server", "Neo's HTTP Server")
-        
-    def send_header(self, name, value):
-        self.wfile.write("%s: %s\r\n"%(name, value))
-        if name.lower() == "connection":
-            if value.lower() == "close":
-                self.close_connection = True
-            elif value.lower() == "keep-alive":
-                self.close_connection = False
+    def submit(self, func, *args):
+        # raises Queue.Full when all workers are busy and the wait queue is full
+        self.tasks.put_nowait((func, args))
 
-    def end_headers(self):
-        self.wfile.write("\r\n")
-        
-    def send_error_response(self, code, explanation):
-        self.send_response_line(code, explanation)
-        self.send_header("Content-type", "text/html")
-        self.send_header("Connection", "close")
-        self.end_headers()
-        message_body = error_tpl%(code, code,  explanation)
-        self.wfile.write(message_body)
-        if not self.wfile.closed:
-            self.wfile.flush()
+    def _work(self):
+        while True:
+            func, args = self.tasks.get()
+            try:
+                func(*args)
+            except Exception, e:
+                add_error_log(str(e))
+
+# File-like object the handlers write responses to, the data is sent by the event loop
+class ConnectionOutput(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.closed = False
+
+    def write(self, data):
+        if data:
+            self.conn.queue_output(data, len(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+# File-like object a request body is read from, fed by the event loop as the data arrives.
+# The loop stops reading the socket while BUFFER_SIZE bytes wait for the handler
+class ConnectionInput(object):
+    BUFFER_SIZE = 256 << 10
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.chunks = collections.deque()
+        self.buffered = 0
+        # all of the body was received
+        self.ended = False
+        self.aborted = False
+        self.discarding = False
+        self.ready = threading.Condition(threading.Lock())
+
+    def full(self):
+        return self.buffered >= self.BUFFER_SIZE
+
+    # called by the loop with the next piece of the body
+    def feed(self, data, last):
+        with self.ready:
+            if not self.discarding:
+                self.chunks.append(data)
+                self.buffered += len(data)
+            self.ended = last
+            self.ready.notify_all()
+
+    def abort(self):
+        with self.ready:
+            self.aborted = True
+            self.ready.notify_all()
+
+    # the response is sent, what's left of the body is dropped as it comes
+    def discard(self):
+        with self.ready:
+            self.discarding = True
+            self.chunks.clear()
+            self.buffered = 0
+
+    def read(self, size):
+        return self._read(size, False)
+
+    def readline(self, size):
+        return self._read(size, True)
+
+    def _read(self, size, line):
+        with self.ready:
+            while True:
+                if line:
+                    size = min(size, self._line_length(size))
+                if self.buffered >= size or self.ended or self.aborted:
+                    break
+                # a handler running on the loop gets what is there, it can't wait for it
+                if self.conn.loop.in_loop_thread():
+                    break
+                self.ready.wait()
+            if self.aborted and self.buffered < size:
+                raise ConnectionAborted()
+            was_full = self.full()
+            data = self._take(size)
+        if was_full and not self.full():
+            self.conn.loop.call_soon(self.conn.update_events)
+        return data
+
+    # bytes up to the first newline, size if there is none in the buffer yet
+    def _line_length(self, size):
+        length = 0
+        for chunk in self.chunks:
+            end = chunk.find("\n")
+            if end >= 0:
+                return length + end + 1
+            length += len(chunk)
+            if length >= size:
+                break
+        return size
+
+    def _take(self, size):
+        parts = []
+        taken = 0
+        while taken < size and self.chunks:
+            chunk = self.chunks.popleft()
+            if taken + len(chunk) > size:
+                self.chunks.appendleft(chunk[size - taken:])
+                chunk = chunk[:size - taken]
+            parts.append(chunk)
+            taken += len(chunk)
+        self.buffered -= taken
+        return "".join(parts)
+
+# A part of a file queued on a connection, sent by the event loop with sendfile
+class FileSegment(object):
+    def __init__(self, f, offset, count):
+        self.f = f
+        self.offset = offset
+        self.count = count
+
+# The request object handed to handlers, it plays the role of HTTPServerHandler
+class EventLoopRequest(HTTPResponseMixin):
+    def __init__(self, conn):
+        self.connection = conn
+        self.client_address = conn.client_address
+        self.wfile = ConnectionOutput(conn)
+        self.url_scheme = conn.url_scheme
+        self.rfile = None
+        self.error = StringIO.StringIO()
+        self.close_connection = True
+        self.started = time.time()
+        self.metrics = None
+        self.body_length = 0
+        self.verb = "GET"
+        self.path = "-"
+        self.version = "HTTP/1.0"
+        self.reset_response()
+
+    def write_file(self, f, offset, count):
+        # the segment sends from a descriptor of its own, closed once it's sent: the
+        # handler closes f when it's done writing, before the loop is done sending
+        segment = FileSegment(os.fdopen(os.dup(f.fileno()), "rb"), offset, count)
+        try:
+            self.connection.queue_output(segment, 0)
+        except:
+            segment.f.close()
+            raise
+
+class EventLoopConnection(object):
+    MAX_HEADER_SIZE = request_parser.MAX_HEAD_SIZE
+    # a worker writing a response blocks when this many bytes are waiting to be sent
+    HIGH_WATER = 1 << 20
+    SEND_SIZE = 65536
+
+    def __init__(self, loop, sock, client_address, ssl_context=None):
+        self.loop = loop
+        self.fileno = sock.fileno()
+        self.client_address = client_address
+        self.url_scheme = "http"
+        self.alpn_protocol = None
+        # the TLS handshake is done by the loop, a step each time the socket is ready
+        self.handshaking = False
+        if ssl_context is not None:
+            sock = ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+            self.url_scheme = "https"
+            self.handshaking = True
+        self.sock = sock
+        self.inbuf = ""
+        self.outbuf = collections.deque()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.drained = threading.Condition(self.lock)
+        self.wake_scheduled = False
+        self.events = select.EPOLLIN
+        # the request being read, and the one being responded to
+        self.incoming = None
+        self.head_searched = 0
+        # the body being received, handed to the handler while it arrives
+        self.body = None
+        self.body_remaining = 0
+        # close once the rest of the body is received
+        self.close_after_body = False
+        self.request = None
+        self.response_done = False
+        self.eof = False
+        self.closed = False
+        self.requests_handled = 0
+        self.last_active = time.time()
+
+    def idle(self):
+        return self.request is None and self.incoming is None and not self.inbuf
+
+    # whether the connection waits for the client to send something, a request or the
+    # rest of a body
+    def waiting_for_client(self):
+        if self.body_remaining:
+            return not self.body.full()
+        return self.request is None and not self.outbuf
+
+    def handshake(self):
+        try:
+            self.sock.do_handshake()
+        except socket.error, e:
+            if would_block(e):
+                self.loop.modify(self, select.EPOLLOUT if wants_write(e) else select.EPOLLIN)
+            else:
+                self.close()
+            return
+        self.handshaking = False
+        self.last_active = time.time()
+        self.alpn_protocol = self.sock.selected_alpn_protocol()
+        self.update_events()
+
+    def on_readable(self):
+        if self.handshaking:
+            self.handshake()
+            return
+        try:
+            data = self.sock.recv(self.SEND_SIZE)
+            if self.url_scheme == "https":
+                # epoll doesn't know about the bytes openssl has decrypted already
+                while data and self.sock.pending():
+                    data += self.sock.recv(self.SEND_SIZE)
+        except socket.error, e:
+            if would_block(e):
+                return
+            self.close()
+            return
+        self.last_active = time.time()
+        if not data:
+            # the client half-closed, finish the response in progress then close
+            if self.request is None:
+                self.close()
+            else:
+                self.eof = True
+                if self.body is not None:
+                    # the rest of the body won't come
+                    self.body.abort()
+                self.update_events()
+            return
+        if self.body_remaining:
+            self.read_body(data)
+        else:
+            self.inbuf += data
+        self.process_input()
+
+    def read_body(self, data):
+        chunk = data[:self.body_remaining]
+        self.body_remaining -= len(chunk)
+        self.body.feed(chunk, not self.body_remaining)
+        if not self.body_remaining:
+            self.body = None
+            if self.close_after_body:
+                self.close()
+                return
+        if len(chunk) < len(data):
+            self.inbuf += data[len(chunk):]
+        elif self.body is not None and self.body.full():
+            self.update_events()
+
+    def process_input(self):
+        # requests of a connection are answered in order, pipelined ones wait in inbuf
+        if self.request is not None or self.closed:
+            return
+        if self.incoming is None:
+            if self.inbuf[:1] in ("\r", "\n"):
+                self.inbuf = self.inbuf.lstrip("\r\n")
+                self.head_searched = 0
+            # search only the bytes received since the last look
+            end, size = request_parser.find_head_end(self.inbuf, max(0, self.head_searched - 3))
+            if end < 0:
+                self.head_searched = len(self.inbuf)
+                if len(self.inbuf) > self.MAX_HEADER_SIZE:
+                    self.reject(431, "Request Header Fields Too Large")
+                return
+            head, self.inbuf = self.inbuf[:end], self.inbuf[end+size:]
+            self.head_searched = 0
+            if not self.start_request(head):
+                return
+        if self.body_remaining and self.inbuf:
+            data, self.inbuf = self.inbuf, ""
+            self.read_body(data)
+        # the handler starts before the body is received, and reads it as it comes
+        req, self.incoming = self.incoming, None
+        self.dispatch(req)
+
+    def start_request(self, head):
+        req = EventLoopRequest(self)
+        try:
+            req.parse_request(head)
+        except request_parser.RequestParseError, e:
+            self.reject(e.code, e.reason)
+            return False
+        req.parse_connection_header()
+        self.requests_handled += 1
+        if self.loop.max_requests and self.requests_handled >= self.loop.max_requests:
+            req.close_connection = True
+        try:
+            length = req.request_body_length()
+        except ValueError:
+            self.reject(400, "Invalid Content-Length")
+            return False
+        if length is None:
+            self.reject(411, "Length Required")
+            return False
+        if self.loop.max_body_size and length > self.loop.max_body_size:
+            self.reject(413, "Request Entity Too Large")
+            return False
+        if length and req.headers.get("Expect", "").lower() == "100-continue":
+            self.queue_output("HTTP/1.1 100 Continue\r\n\r\n", 25)
+            self.update_events()
+        if length:
+            self.body = ConnectionInput(self)
+        req.rfile = RequestBodyReader(self.body, length)
+        req.body_length = self.body_remaining = length
+        self.incoming = req
+        return True
+
+    def reject(self, code, explanation):
+        req = EventLoopRequest(self)
+        self.request = req
+        req.send_error_response(code, explanation)
+        self.finish_request()
+
+    def dispatch(self, req):
+        self.request = req
+        self.response_done = False
+        handler = req.route_request()
+        if not handler:
+            req.send_error_response(404, "File Not Found")
+            self.finish_request()
+            return
+        req.limits = []
+        self.acquire_limits(req, handler, req.request_limits(handler))
+
+    # get a slot of each limit in turn, waiting in the queue of a busy one
+    def acquire_limits(self, req, handler, limits):
+        while len(req.limits) < len(limits):
+            limit = limits[len(req.limits)]
+            def on_slot(granted, limit=limit):
+                self.loop.call_soon(self.limit_decided, req, handler, limits, limit, granted)
+            granted = limit.acquire_async(on_slot)
+            if granted is None:
+                self.loop.limits.add(limit)
+                return
+            if not granted:
+                self.overloaded(req, handler)
+                return
+            req.limits.append(limit)
+        self.run_with_limits(req, handler)
+
+    def limit_decided(self, req, handler, limits, limit, granted):
+        if granted:
+            req.limits.append(limit)
+            if self.closed:
+                self.abandon(req)
+                return
+            self.acquire_limits(req, handler, limits)
+        elif not self.closed:
+            self.overloaded(req, handler)
+        else:
+            self.abandon(req)
+
+    # the connection closed while the request waited for a slot
+    def abandon(self, req):
+        self.release_limits(req)
+        req.request_done()
+
+    def overloaded(self, req, handler):
+        self.release_limits(req)
+        req.send_overloaded(handler)
+        self.finish_request()
+
+    def release_limits(self, req):
+        limits, req.limits = req.limits, []
+        for limit in limits:
+            limit.release()
+
+    # handlers tell with blocks(req) whether a request may block, or with the blocking
+    # attribute for all of them
+    def blocks(self, req, handler):
+        if hasattr(handler, "blocks"):
+            return handler.blocks(req)
+        return getattr(handler, "blocking", True)
+
+    def run_with_limits(self, req, handler):
+        if self.blocks(req, handler):
+            try:
+                self.loop.pool.submit(self.run_handler, req, handler)
+            except Queue.Full:
+                req.send_error_response(503, "Server Busy")
+                self.finish_request()
+        else:
+            self.run_handler(req, handler)
+
+    def run_handler(self, req, handler):
+        try:
+            handler.handle_request(req)
+            req.finish_response()
+            req.log_request_errors()
+        except ConnectionAborted:
+            req.close_connection = True
+        except Exception, e:
+            add_error_log(str(e))
+            req.close_connection = True
+        self.release_limits(req)
+        if self.loop.in_loop_thread():
+            self.finish_request()
+        else:
+            self.loop.call_soon(self.finish_request)
+
+    def finish_request(self):
+        self.request.request_done()
+        if self.closed:
+            return
+        self.response_done = True
+        self.update_events()
+
+    # called from the handler, either in the loop thread or a worker thread.
+    # size is the memory held by the item, file segments are read when sent
+    def queue_output(self, item, size):
+        in_loop = self.loop.in_loop_thread()
+        with self.lock:
+            if self.closed:
+                raise ConnectionAborted()
+            self.outbuf.append(item)
+            self.pending += size
+            if in_loop:
+                return
+            if not self.wake_scheduled:
+                self.wake_scheduled = True
+                self.loop.call_soon(self.update_events)
+            while self.pending > self.HIGH_WATER and not self.closed:
+                self.drained.wait(1)
+
+    def send_segment(self, segment):
+        if sendfile is None or self.url_scheme == "https":
+            # send the next piece from memory
+            segment.f.seek(segment.offset)
+            data = segment.f.read(min(segment.count, self.SEND_SIZE))
+            # a TLS socket sends nothing rather than raising when it would block
+            sent = self.sock.send(data) if data else 0
+            truncated = not data
+        else:
+            try:
+                sent = sendfile(self.fileno, segment.f.fileno(), segment.offset, segment.count)
+            except OSError, e:
+                raise socket.error(e.errno, e.strerror)
+            truncated = not sent
+        segment.offset += sent
+        segment.count -= sent
+        if truncated:
+            # can't send the promised length
+            raise socket.error(errno.EPIPE, "File truncated")
+
+    def flush_output(self):
+        error = False
+        with self.lock:
+            while self.outbuf:
+                data = self.outbuf.popleft()
+                if isinstance(data, FileSegment):
+                    try:
+                        self.send_segment(data)
+                    except socket.error, e:
+                        if not would_block(e):
+                            error = True
+                    if data.count > 0:
+                        self.outbuf.appendleft(data)
+                        break
+                    data.f.close()
+                    if error:
+                        break
+                    continue
+                # coalesce small writes (status line, headers) into one send
+                while (self.outbuf and len(data) < self.SEND_SIZE
+                        and not isinstance(self.outbuf[0], FileSegment)):
+                    data += self.outbuf.popleft()
+                try:
+                    sent = self.sock.send(data)
+                except socket.error, e:
+                    # a TLS write must be retried with the same data
+                    self.outbuf.appendleft(data)
+                    if not would_block(e):
+                        error = True
+                    break
+                self.pending -= sent
+                self.last_active = time.time()
+                if sent < len(data):
+                    self.outbuf.appendleft(data[sent:])
+                    break
+            if self.pending <= self.HIGH_WATER:
+                self.drained.notify_all()
+        if error:
+            self.close()
+
+    def on_writable(self):
+        if self.handshaking:
+            self.handshake()
+            return
+        self.update_events()
+
+    def update_events(self):
+        with self.lock:
+            self.wake_scheduled = False
+        if self.closed:
+            return
+        if self.outbuf:
+            self.flush_output()
+            if self.closed:
+                return
+        if not self.outbuf and self.response_done:
+            self.response_sent()
+            if self.closed:
+                return
+        mask = 0
+        if self.eof:
+            pass
+        elif self.body_remaining:
+            # until the handler catches up with the body
+            if not self.body.full():
+                mask |= select.EPOLLIN
+        elif self.request is None or len(self.inbuf) < self.MAX_HEADER_SIZE:
+            mask |= select.EPOLLIN
+        if self.outbuf:
+            mask |= select.EPOLLOUT
+        self.loop.modify(self, mask)
+
+    def response_sent(self):
+        req, self.request = self.request, None
+        self.response_done = False
+        if self.body_remaining and not self.eof:
+            # the handler didn't read all of the body, the rest is dropped as it comes.
+            # Closing before it's all there would reset the connection, and the client
+            # could lose the response
+            self.body.discard()
+            if req.close_connection:
+                self.close_after_body = True
+                return
+        if req.close_connection or self.eof:
+            self.close()
+        elif self.inbuf:
+            # a pipelined request, handled on the next turn to keep the stack flat
+            self.loop.call_soon(self.process_input)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            segments = [item for item in self.outbuf if isinstance(item, FileSegment)]
+            self.outbuf.clear()
+            self.pending = 0
+            self.drained.notify_all()
+        for segment in segments:
+            segment.f.close()
+        if self.body is not None:
+            # a worker may be waiting for the rest of the body
+            self.body.abort()
+        self.loop.unregister(self)
+        if self.url_scheme == "https" and not self.handshaking:
+            shutdown_tls(self.sock)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+class EventLoopServer(object):
+    request_queue_size = 1024
+    accept_batch = 64
+    # keep-alive limits, seconds a connection may stay without a request and
+    # requests answered on a connection
+    idle_timeout = 15
+    max_requests = 100
+    ssl_context = None
+    # larger request bodies get a 413, 0 for no limit
+    max_body_size = 0
+
+    def __init__(self, server_address, worker_threads, worker_queue, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(server_address)
+            sock.listen(self.request_queue_size)
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.poller = select.epoll()
+        self.poller.register(self.socket.fileno(), select.EPOLLIN)
+        # worker threads wake up the loop by writing to a pipe
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller.register(self._wakeup_r, select.EPOLLIN)
+        self.callbacks = collections.deque()
+        self.connections = {}
+        self.pool = WorkerPool(worker_threads, worker_queue)
+        # concurrency limits with requests of this loop waiting in their queue
+        self.limits = set()
+        self.thread = None
+        self._stop_deadline = None
+        self._last_sweep = time.time()
+
+    # stop accepting, and return from serve_forever once the requests in progress are
+    # answered or the timeout expires. Safe to call from a signal handler
+    def shutdown(self, timeout=30):
+        self._stop_deadline = time.time() + timeout
+
+    def _drain(self):
+        if self.socket is not None:
+            self.poller.unregister(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+        for conn in self.connections.values():
+            if conn.idle():
+                conn.close()
+        return not self.connections or time.time() > self._stop_deadline
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self.thread
+
+    def call_soon(self, callback, *args):
+        self.callbacks.append((callback, args))
+        if self.in_loop_thread():
+            # callbacks are run at the end of every loop iteration
+            return
+        try:
+            os.write(self._wakeup_w, "x")
+        except OSError:
+            # the pipe is full, the loop is going to wake up anyway
+            pass
+
+    def modify(self, conn, mask):
+        if conn.events != mask:
+            conn.events = mask
+            self.poller.modify(conn.fileno, mask)
+
+    def unregister(self, conn):
+        self.connections.pop(conn.fileno, None)
+        try:
+            self.poller.unregister(conn.fileno)
+        except (IOError, ValueError):
+            pass
+
+    def _accept(self):
+        for i in range(self.accept_batch):
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = EventLoopConnection(self, sock, client_address, self.ssl_context)
+            self.connections[conn.fileno] = conn
+            self.poller.register(conn.fileno, conn.events)
+
+    # close the connections waiting for a request, or a body, for longer than idle_timeout
+    def _close_idle(self):
+        now = time.time()
+        self._last_sweep = now
+        for conn in self.connections.values():
+            if conn.waiting_for_client() and now - conn.last_active > self.idle_timeout:
+                conn.close()
+
+    # turn away the requests waiting for a concurrency limit past their queue_timeout
+    def _expire_limits(self):
+        for limit in list(self.limits):
+            limit.expire()
+            if not limit.waiters:
+                self.limits.discard(limit)
+
+    def _run_callbacks(self):
+        try:
+            while True:
+                os.read(self._wakeup_r, 4096)
+        except OSError:
+            pass
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+    def serve_forever(self):
+        self.thread = threading.current_thread()
+        listen_fd = self.socket.fileno()
+        while True:
+            if self._stop_deadline is not None and self._drain():
+                return
+            try:
+                # wake up often enough to expire the requests waiting for a limit
+                events = self.poller.poll(0.1 if self.limits else 1)
+            except IOError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == listen_fd:
+                    self._accept()
+                elif fd == self._wakeup_r:
+                    self._run_callbacks()
+                else:
+                    conn = self.connections.get(fd)
+                    if conn is None:
+                        continue
+                    if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                        conn.on_readable()
+                    if event & select.EPOLLOUT and not conn.closed:
+                        conn.on_writable()
+            if self.limits:
+                self._expire_limits()
+            if self.callbacks:
+                self._run_callbacks()
+            if time.time() - self._last_sweep >= 1:
+                self._close_idle()
         
+# Thread per connection server answering connections over max_connections (0 for no
+# limit) with a 503 from the accepting thread, instead of starting a thread for them
+class BoundedThreadingTCPServer(SocketServer.ThreadingTCPServer):
+    max_connections = 0
+    retry_after = 1
+
+    def __init__(self, *args, **kwargs):
+        SocketServer.ThreadingTCPServer.__init__(self, *args, **kwargs)
+        self.connections = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            busy = self.max_connections and self.connections >= self.max_connections
+            if not busy:
+                self.connections += 1
+        if busy:
+            self.rejected += 1
+            try:
+                if getattr(self, "ssl_context", None) is None:
+                    request.sendall(overloaded_response % self.retry_after)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            SocketServer.ThreadingTCPServer.process_request(self, request, client_address)
+        except:
+            self.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingTCPServer.process_request_thread(self, request, client_address)
+        finally:
+            self.release()
+
+    def release(self):
+        with self.lock:
+            self.connections -= 1
+
+overloaded_response = ("HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\n"
+                       "Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+# Prefork mode: the master process binds the listening socket and forks a fixed number of
+# workers, each running a thread or epoll server on the inherited socket. SIGHUP replaces
+# the workers gracefully, workers that die unexpectedly are respawned.
+class PreforkServer(object):
+    def __init__(self, webserver, sock, workers, worker_mode, graceful_timeout):
+        self.webserver = webserver
+        self.socket = sock
+        self.num_workers = workers
+        self.worker_mode = worker_mode
+        self.graceful_timeout = graceful_timeout
+        # pid -> start time of the current workers
+        self.workers = {}
+        # old workers finishing their requests after a restart
+        self.retiring = set()
+        self._restart = False
+        self._stopping = False
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker()
+            except Exception, e:
+                add_error_log("Worker %d failed: %s"%(os.getpid(), str(e)))
+                code = 1
+            finally:
+                access_log.flush()
+                os._exit(code)
+        self.workers[pid] = time.time()
+
+    def _run_worker(self):
+        # the master handles ctrl-c and HUP, and tells the workers to stop with TERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server = self.webserver._make_server(self.worker_mode, self.socket)
+        def stop(signum, frame):
+            if isinstance(server, EventLoopServer):
+                server.shutdown(self.graceful_timeout)
+            else:
+                # shutdown waits for serve_forever to return, so it can't run in this thread
+                t = threading.Thread(target=server.shutdown)
+                t.daemon = True
+                t.start()
+        signal.signal(signal.SIGTERM, stop)
+        server.serve_forever()
+        # wait for the requests in progress on the handler threads
+        deadline = time.time() + self.graceful_timeout
+        for t in threading.enumerate():
+            if t is not threading.current_thread() and not t.daemon:
+                t.join(max(0, deadline - time.time()))
+
+    def restart_workers(self):
+        old = list(self.workers)
+        self.workers = {}
+        for i in range(self.num_workers):
+            self.spawn_worker()
+        for pid in old:
+            self.retiring.add(pid)
+            self._kill(pid, signal.SIGTERM)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if not pid:
+                return
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif pid in self.workers:
+                started = self.workers.pop(pid)
+                if self._stopping:
+                    continue
+                add_error_log("Worker %d exited with status %d, respawning..."%(pid, status))
+                if time.time() - started < 1:
+                    # crashing on start, don't respawn in a tight loop
+                    time.sleep(1)
+                self.spawn_worker()
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+    def _on_hup(self, signum, frame):
+        self._restart = True
+
+    def request_restart(self):
+        self._restart = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def serve_forever(self):
+        signal.signal(signal.SIGHUP, self._on_hup)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for i in range(self.num_workers):
+            self.spawn_worker()
+        while not self._stopping:
+            # signals interrupt the sleep
+            time.sleep(1)
+            if self._restart:
+                self._restart = False
+                # the new workers are forked with the new routes, a broken
+                # config leaves the running workers alone
+                if self.webserver.reload():
+                    add_info_log("Restarting workers...")
+                    self.restart_workers()
+                else:
+                    add_error_log("Not restarting workers, the old config stays active")
+            self.reap_workers()
+        # stop all the workers, killing the ones that don't exit in time
+        pids = set(self.workers) | self.retiring
+        for pid in pids:
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout + 1
+        while (self.workers or self.retiring) and time.time() < deadline:
+            time.sleep(0.1)
+            self.reap_workers()
+        for pid in set(self.workers) | self.retiring:
+            self._kill(pid, signal.SIGKILL)
+
 # helper functions
 def timestamp_to_string(timestamp=None):
     """Return the current date and time formatted for a message header."""
@@ -475,11 +2974,168 @@ def timestamp_to_string(timestamp=None):
             hh, mm, ss)
     return s
 
+def guess_content_type(path):
+    _, ext = os.path.splitext(path)
+    # ignore case of extension, and default to text/html
+    return mimetypes.types_map.get(ext.lower(), "text/html")
+
+# An entity tag built from the inode, size and modification time of a file
+def make_etag(st):
+    return '"%x-%x-%x"'%(st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+
+# Evaluate If-None-Match/If-Modified-Since request headers, False means a 304 can be sent.
+# If-None-Match takes precedence, and entity tags are compared weakly
+def is_modified(headers, etag, mtime):
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == etag:
+                return False
+        return True
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since:
+        parsed = email.utils.parsedate_tz(if_modified_since)
+        if parsed is not None:
+            return int(mtime) > email.utils.mktime_tz(parsed)
+    return True
+
+# Parse the value of a Range header against a file of the given size.
+# Returns a list of (start, end) inclusive byte ranges, an empty list when none of them
+# is satisfiable, or None when the header is invalid and should be ignored
+MAX_RANGES = 16
+def parse_range_header(value, size):
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    specs = [r.strip() for r in spec.split(",") if r.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    for r in specs:
+        first, sep, last = r.partition("-")
+        if not sep:
+            return None
+        try:
+            if not first:
+                # suffix range, the last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else start
+                if end < start:
+                    return None
+                if not last:
+                    end = size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    return ranges
+
+# sendfile(out_fd, in_fd, offset, count), os.sendfile on python 3.3+, and called through
+# ctypes on linux otherwise. None when the platform doesn't have it
+def _load_sendfile():
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        sent = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+sendfile = _load_sendfile()
+
+# (name, is_dir, size, mtime) of the entries of a directory, sorted by name. Sizes and
+# times are only read when with_stat is true, is_dir is None when it would take a stat
+# too: scandir gets it with the names, listdir doesn't
+def scan_directory(path, with_stat=False):
+    if scandir is None and not with_stat:
+        # sorting plain names is much faster than sorting tuples
+        names = os.listdir(path)
+        names.sort()
+        return [(name, None, 0, 0) for name in names]
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if with_stat:
+                    st = entry.stat()
+                    entries.append((entry.name, entry.is_dir(), st.st_size, st.st_mtime))
+                else:
+                    entries.append((entry.name, entry.is_dir(), 0, 0))
+            except OSError:
+                # removed while listing
+                continue
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            entries.append((name, stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime))
+    entries.sort(key=operator.itemgetter(0))
+    return entries
+
+# whether a socket error of a non-blocking socket means trying again later,
+# openssl may need to read or write before going on, whatever was asked
+def would_block(e):
+    if ssl is not None and isinstance(e, ssl.SSLError):
+        return e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+    return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def wants_write(e):
+    return ssl is not None and isinstance(e, ssl.SSLError) and e.args[0] == ssl.SSL_ERROR_WANT_WRITE
+
+# Send the TLS close_notify without waiting for the client's. The session of a
+# connection closed without it is dropped from the cache and can't be resumed
+def shutdown_tls(sock):
+    try:
+        sock.setblocking(0)
+        sock.unwrap()
+    except (socket.error, ValueError):
+        pass
+
+# copy count bytes of f starting at offset to wfile, when sendfile is not usable
+def copy_file_range(f, offset, count, wfile, bufsize=65536):
+    f.seek(offset)
+    while count > 0:
+        data = f.read(min(bufsize, count))
+        if not data:
+            break
+        wfile.write(data)
+        count -= len(data)
+
+# records are written by a background thread, see access_log.py
 def add_error_log(entry):
-    print "[ERROR] - " + entry
+    access_log.log_error(entry)
+
+def add_info_log(entry):
+    access_log.log_error(entry, "INFO")
 
-def add_access_log(entry):
-    print "[REQUEST] - " + entry
+def add_access_log(client, verb, path, version, status, size, latency, referer=None, agent=None):
+    access_log.log_request(client, verb, path, version, status, size, latency, referer, agent)
 
 # The driver
 def main():